@@ -27,16 +27,33 @@ DATABASES = {
 STATIC_ROOT = '/var/www/wahlfang/static'
 # Alias this location from your webserver to `/media`
 MEDIA_ROOT = '/var/www/wahlfang/media'
+# Storage of uploaded voter lists and generated token sheets, do NOT serve this location from your webserver
+PRIVATE_MEDIA_ROOT = '/var/lib/wahlfang/private'
+# Render token sheets with the built-in PDF writer instead of pdflatex
+# TOKEN_SHEET_RENDERER = 'vector'
 
+# Shared by all daphne processes and the email workers, see docs/deploying.md
 CHANNEL_LAYERS = {
     "default": {
         "BACKEND": "channels_redis.core.RedisChannelLayer",
         "CONFIG": {
             "hosts": [("127.0.0.1", 6379)],
+            # messages that are queued for a single socket before further messages to it are dropped
+            "capacity": 200,
+            "expiry": 30,
         },
     },
 }
 
+# Shared by all processes, on another database of the redis server of the channel layer (requires `django-redis`).
+# Memcached works as well, see docs/deploying.md.
+CACHES = {
+    "default": {
+        "BACKEND": "django_redis.cache.RedisCache",
+        "LOCATION": "redis://127.0.0.1:6379/1",
+    },
+}
+
 # Make sure that this directory is created or Django will fail on start.
 LOGGING['handlers']['file']['filename'] = '/var/log/wahlfang/wahlfang.log'
 
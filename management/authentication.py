@@ -43,7 +43,7 @@ class ManagementBackend(BaseBackend):
         return None
 
     def get_user(self, user_id):
-        return ElectionManager.objects.filter(pk=user_id).first()
+        return ElectionManager.get_cached(user_id)
 
 
 class ManagementBackendLDAP(LDAPBackend):
@@ -2,44 +2,53 @@ import json
 
 from channels.generic.websocket import AsyncWebsocketConsumer
 
+from vote.consumers import ConsumerMetricsMixin
 
-class ElectionConsumer(AsyncWebsocketConsumer):
 
-    async def connect(self):
-        self.group = "Election-" + \
-            self.scope['url_route']['kwargs']['pk']  # pylint: disable=W0201
-        await self.channel_layer.group_add(self.group, self.channel_name)
-        await self.accept()
+class ElectionConsumer(ConsumerMetricsMixin, AsyncWebsocketConsumer):
+    consumer_name = 'election'
 
-    async def disconnect(self, code):
-        await self.channel_layer.group_discard(self.group, self.channel_name)
+    async def connect(self):
+        await self.join(["Election-" + self.scope['url_route']['kwargs']['pk']])
 
     async def send_reload(self, event):
         await self.send(text_data=json.dumps({
             'reload': event['id'],
         }))
 
+    async def send_counters(self, event):
+        await self.send(text_data=json.dumps({
+            'counters': event['counters'],
+        }))
+
 
-class SessionConsumer(AsyncWebsocketConsumer):
+class SessionConsumer(ConsumerMetricsMixin, AsyncWebsocketConsumer):
+    consumer_name = 'session'
 
     async def connect(self):
         session = self.scope['url_route']['kwargs']['pk']
         # reload if a new voter logged in, or if a election of the session was changed (like added)
-        self.groups = ["Login-Session-" + session, "Session-" + session,
-                       "SessionAlert-" + session]  # pylint: disable=W0201
-        for group in self.groups:
-            await self.channel_layer.group_add(group, self.channel_name)
-        await self.accept()
-
-    async def disconnect(self, code):
-        for group in self.groups:
-            await self.channel_layer.group_discard(group, self.channel_name)
+        await self.join(["Login-Session-" + session, "Session-" + session, "SessionAlert-" + session])
 
     async def send_reload(self, event):
         await self.send(text_data=json.dumps({
             'reload': event['id'],
         }))
 
+    async def send_counters(self, event):
+        await self.send(text_data=json.dumps({
+            'counters': event['counters'],
+        }))
+
+    async def send_election(self, event):
+        await self.send(text_data=json.dumps({
+            'election': {
+                'id': event['id'],
+                'section': event['section'],
+                'html': event['cards']['management'] if event['cards'] is not None else None,
+            },
+        }))
+
     async def send_alert(self, event):
         await self.send(text_data=json.dumps({
             'alert': {'title': event.get('title', 'Alert'), 'msg': event['msg'], 'reload': event.get('reload')},
@@ -50,17 +59,17 @@ class SessionConsumer(AsyncWebsocketConsumer):
             'succ': event['msg'],
         }))
 
+    async def send_progress(self, event):
+        await self.send(text_data=json.dumps({
+            'progress': {'id': event['id'], 'done': event['done'], 'total': event['total']},
+        }))
 
-class AddMobileConsumer(AsyncWebsocketConsumer):
 
-    async def connect(self):
-        self.group = "QR-Reload-" + \
-            self.scope['url_route']['kwargs']['pk']  # pylint: disable=W0201
-        await self.channel_layer.group_add(self.group, self.channel_name)
-        await self.accept()
+class AddMobileConsumer(ConsumerMetricsMixin, AsyncWebsocketConsumer):
+    consumer_name = 'add_mobile'
 
-    async def disconnect(self, code):
-        await self.channel_layer.group_discard(self.group, self.channel_name)
+    async def connect(self):
+        await self.join(["QR-Reload-" + self.scope['url_route']['kwargs']['pk']])
 
     async def send_reload(self, event):
         await self.send(text_data=json.dumps({
@@ -7,9 +7,10 @@ from typing import Tuple, List
 from django import forms
 from django.conf import settings
 from django.core.validators import validate_email
+from django.db import transaction
 from django.utils import timezone
 
-from management.models import ElectionManager
+from management.models import ElectionManager, MailJob, VoterImport
 from vote.models import Election, Application, Session, Voter, OpenVote
 
 
@@ -245,15 +246,17 @@ class AddElectionForm(forms.ModelForm, TemplateStringForm):
         return self.cleaned_data
 
     def save(self, commit=True):
-        instance = super().save(commit=commit)
-        self.session.elections.add(instance)
-        if commit:
-            self.session.save()
-            open_votes = [
-                OpenVote(voter=v, election=instance)
-                for v in self.session.participants.all()
-            ]
-            OpenVote.objects.bulk_create(open_votes)
+        # the election card is pushed when the transaction commits, it must already include the open votes
+        with transaction.atomic():
+            instance = super().save(commit=commit)
+            self.session.elections.add(instance)
+            if commit:
+                self.session.save()
+                open_votes = [
+                    OpenVote(voter=v, election=instance)
+                    for v in self.session.participants.all()
+                ]
+                OpenVote.objects.bulk_create(open_votes)
 
         return instance
 
@@ -297,34 +300,38 @@ class AddVotersForm(forms.Form):
         super().__init__(*args, **kwargs)
         self.session = session
 
-    def save(self) -> List[Tuple[Voter, str]]:
-        voters_codes = [
-            Voter.from_data(email=email, session=self.session) for email in self.cleaned_data['voters_list']
-        ]
-        self.session.managers.all().first().send_invite_bulk_threaded(voters_codes)
-        return voters_codes
+    def save(self) -> List[Voter]:
+        # the invitations issue the access codes
+        voters = [voter for voter, _ in Voter.bulk_from_data(
+            self.session, [{'email': email} for email in self.cleaned_data['voters_list']], access_codes=False
+        )]
+        MailJob.enqueue(MailJob.INVITATION, voters, self.session.managers.all().first().sender_email)
+        return voters
 
     def clean_voters_list(self):
         lines = self.cleaned_data['voters_list'].splitlines()
-        emails = []
-        for line in lines:
+        existing_emails = self.session.participant_emails()
+        emails = {}
+        for line_number, line in enumerate(lines, start=1):
             if line == '':
                 continue
 
             try:
                 validate_email(line)
             except forms.ValidationError:
-                self.add_error('voters_list', f'{line} is not a valid email address')
+                self.add_error('voters_list', f'line {line_number}: {line} is not a valid email address')
 
-            if Voter.objects.filter(email=line, session=self.session).exists():
-                self.add_error('voters_list', f'a voter with email address {line} already exists')
+            if line in existing_emails:
+                self.add_error('voters_list', f'line {line_number}: a voter with email address {line} already exists')
 
-            emails.append(line)
+            if line in emails:
+                self.add_error('voters_list', f'line {line_number}: duplicate email address {line}, '
+                                              f'already on line {emails[line]}')
+                continue
 
-        if len(emails) != len(set(emails)):
-            raise forms.ValidationError('duplicate email address')
+            emails[line] = line_number
 
-        return emails
+        return list(emails)
 
 
 class AddTokensForm(forms.Form):
@@ -335,9 +342,9 @@ class AddTokensForm(forms.Form):
         self.session = session
 
     def save(self) -> List[Tuple[Voter, str]]:
-        anonymous_voters = [
-            Voter.from_data(session=self.session) for _ in range(self.cleaned_data['nr_anonymous_voters'])
-        ]
+        anonymous_voters = Voter.bulk_from_data(
+            self.session, [{} for _ in range(self.cleaned_data['nr_anonymous_voters'])]
+        )
 
         return anonymous_voters
 
@@ -350,37 +357,50 @@ class CSVUploaderForm(forms.Form):
         self.session = session
 
     def clean_csv_data(self):
-        f = self.cleaned_data['csv_data'].file
-        data = {}
+        csv_data = self.cleaned_data['csv_data']
+        existing_emails = self.session.participant_emails()
+        emails = {}
+        self.total_rows = 0  # pylint: disable=W0201
+        # only validate the file here, the voters are inserted by a VoterImport in the background
+        text_file = io.TextIOWrapper(csv_data.file, encoding='utf-8', newline='')
         try:
-            with io.TextIOWrapper(f, encoding='utf-8') as text_file:
-                csv_reader = csv.DictReader(text_file)
-                if 'email' not in csv_reader.fieldnames or 'name' not in csv_reader.fieldnames:
-                    raise forms.ValidationError('CSV file needs to have columns "email" and "name".')
-                for row in csv_reader:
-                    if row['email']:
-                        try:
-                            validate_email(row['email'])
-                        except forms.ValidationError:
-                            self.add_error('csv_data', f'Invalid email {row["email"]}')
-                    else:
-                        row['email'] = None
-
-                    if Voter.objects.filter(session=self.session, email=row['email']).exists():
-                        self.add_error('csv_data', f'Voter with email address {row["email"]} already exists')
-
-                    if row['email'] in data:
-                        self.add_error('csv_data', f'Duplicate email in csv: {row["email"]}')
-
-                    data[row['email']] = row['name']
+            csv_reader = csv.DictReader(text_file)
+            if 'email' not in csv_reader.fieldnames or 'name' not in csv_reader.fieldnames:
+                raise forms.ValidationError('CSV file needs to have columns "email" and "name".')
+            for row in csv_reader:
+                self.total_rows += 1
+                email = row['email'] or None
+                if not email:
+                    continue
+
+                try:
+                    validate_email(email)
+                except forms.ValidationError:
+                    self.add_error('csv_data', f'Line {csv_reader.line_num}: Invalid email {email}')
+
+                if email in existing_emails:
+                    self.add_error('csv_data', f'Line {csv_reader.line_num}: '
+                                               f'Voter with email address {email} already exists')
+
+                if email in emails:
+                    self.add_error('csv_data', f'Line {csv_reader.line_num}: Duplicate email in csv: {email}, '
+                                               f'already on line {emails[email]}')
+                    continue
+                emails[email] = csv_reader.line_num
         except UnicodeDecodeError as e:
             raise forms.ValidationError('File does not seem to be in CSV format.') from e
-
-        return data
-
-    def save(self):
-        voters_codes = [
-            Voter.from_data(session=self.session, email=email, name=name)
-            for email, name in self.cleaned_data['csv_data'].items()
-        ]
-        self.session.managers.all().first().send_invite_bulk_threaded(voters_codes)
+        finally:
+            # keep the uploaded file open, it is stored by save()
+            text_file.detach()
+
+        return csv_data
+
+    def save(self) -> VoterImport:
+        voter_import = VoterImport.objects.create(
+            session=self.session,
+            manager=self.session.managers.all().first(),
+            csv_file=self.cleaned_data['csv_data'],
+            total_rows=self.total_rows,
+        )
+        voter_import.run_threaded()
+        return voter_import
@@ -1,6 +1,7 @@
 from django.core.management.base import BaseCommand
 from django.utils import timezone
 
+from management.models import MailJob
 from vote.models import Election
 
 
@@ -17,5 +18,5 @@ class Command(BaseCommand):
                 continue
             election.remind_text_sent = True
             election.save()
-            for voter in election.session.participants.all():
-                voter.send_reminder(election.session.managers.all().first().sender_email, election)
+            MailJob.enqueue(MailJob.REMINDER, election.session.participants.all(),
+                            election.session.managers.all().first().sender_email, election)
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from management.models import VoterImport
+
+
+class Command(BaseCommand):
+    help = 'Continue voter imports that were interrupted, e.g. by a restart of the server'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-i', '--import-id', type=int, required=False)
+
+    def handle(self, *args, **options):
+        voter_imports = VoterImport.objects.filter(finished=None).select_related('session', 'manager')
+        if options['import_id']:
+            voter_imports = voter_imports.filter(pk=options['import_id'])
+
+        for voter_import in voter_imports:
+            self.stdout.write(f'{voter_import}: continuing at row {voter_import.imported_rows} '
+                              f'of {voter_import.total_rows}')
+            voter_import.run()
+            if voter_import.error:
+                self.stdout.write(self.style.ERROR(f'{voter_import}: {voter_import.error}'))
+                continue
+            self.stdout.write(self.style.SUCCESS(
+                f'{voter_import}: imported {voter_import.imported_rows} rows, skipped {voter_import.skipped_rows}'))
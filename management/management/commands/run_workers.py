@@ -0,0 +1,72 @@
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from management.models import MailJob
+from management.utils import MailConnectionPool, RateLimiter
+
+
+class Command(BaseCommand):
+    help = 'Send the queued invitation and reminder emails'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-c', '--concurrency', type=int, default=settings.MAIL_WORKER_CONCURRENCY,
+                            help='number of emails that are sent in parallel')
+        parser.add_argument('--poll-interval', type=float, default=5,
+                            help='seconds to wait before looking for new jobs when the queue is empty')
+        parser.add_argument('--once', action='store_true', help='exit as soon as there are no due jobs left')
+        parser.add_argument('--rate', type=float, default=settings.MAIL_RATE_LIMIT,
+                            help='maximum number of emails sent per second, 0 means unlimited')
+
+    def handle(self, *args, **options):
+        stop = threading.Event()
+        rate_limiter = RateLimiter(options['rate'])
+
+        def work():
+            # every thread keeps its own connection to the mail server open while there are emails to send
+            connections = MailConnectionPool()
+            try:
+                while not stop.is_set():
+                    job = MailJob.claim()
+                    if job is None:
+                        connections.close()
+                        if options['once']:
+                            return
+                        stop.wait(options['poll_interval'])
+                        continue
+                    rate_limiter.wait()
+                    job.run(connection=connections.get())
+                    if job.last_error:
+                        # the connection may be broken, start over with a new one
+                        connections.close()
+                    self.stdout.write(
+                        f'{job}: {job.get_status_display()}{" - " + job.last_error if job.last_error else ""}')
+            finally:
+                connections.close()
+
+        if options['concurrency'] <= 1:
+            try:
+                work()
+            except KeyboardInterrupt:
+                pass
+            return
+
+        def runner():
+            try:
+                work()
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=runner, args=()) for _ in range(options['concurrency'])]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                thread.join()
+        except KeyboardInterrupt:
+            # let the workers finish the emails they are sending
+            stop.set()
+            for thread in threads:
+                thread.join()
@@ -0,0 +1,30 @@
+# Generated by Django 3.2.25 on 2026-10-18 02:17
+
+from django.db import migrations, models
+import django.db.models.deletion
+import management.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vote', '0033_openvote_unique_vote_index'),
+        ('management', '0002_auto_20201007_1636'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VoterImport',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('csv_file', models.FileField(storage=management.models.private_storage, upload_to=management.models.voter_import_file_name)),
+                ('total_rows', models.PositiveIntegerField(default=0)),
+                ('imported_rows', models.PositiveIntegerField(default=0)),
+                ('skipped_rows', models.PositiveIntegerField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('manager', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='management.electionmanager')),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='voter_imports', to='vote.session')),
+            ],
+        ),
+    ]
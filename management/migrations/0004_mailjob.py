@@ -0,0 +1,44 @@
+# Generated by Django 3.2.25 on 2026-10-18 02:19
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vote', '0033_openvote_unique_vote_index'),
+        ('management', '0003_voterimport'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='voterimport',
+            name='mail_batch',
+            field=models.UUIDField(default=uuid.uuid4),
+        ),
+        migrations.CreateModel(
+            name='MailJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('invitation', 'Invitation'), ('reminder', 'Reminder')], max_length=16)),
+                ('from_email', models.CharField(max_length=254)),
+                ('batch', models.UUIDField(default=uuid.uuid4)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Sending'), ('done', 'Sent'), ('failed', 'Failed')], default='pending', max_length=16)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('run_after', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(default=django.utils.timezone.now)),
+                ('election', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='mail_jobs', to='vote.election')),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='mail_jobs', to='vote.session')),
+                ('voter', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='mail_jobs', to='vote.voter')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='mailjob',
+            index=models.Index(fields=['status', 'run_after'], name='mailjob_status_run_after_idx'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 3.2.25 on 2026-10-18 02:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+import management.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vote', '0033_openvote_unique_vote_index'),
+        ('management', '0004_mailjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TokenSheet',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pdf', models.FileField(blank=True, storage=management.models.private_storage, upload_to=management.models.token_sheet_file_name)),
+                ('fingerprint', models.CharField(blank=True, max_length=64)),
+                ('total', models.PositiveIntegerField(default=0)),
+                ('done', models.PositiveIntegerField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('error', models.TextField(blank=True)),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='token_sheets', to='vote.session')),
+            ],
+        ),
+    ]
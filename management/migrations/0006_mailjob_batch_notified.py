@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 03:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('management', '0005_tokensheet'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mailjob',
+            name='batch_notified',
+            field=models.BooleanField(default=False),
+        ),
+    ]
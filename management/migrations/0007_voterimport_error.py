@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 03:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('management', '0006_mailjob_batch_notified'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='voterimport',
+            name='error',
+            field=models.TextField(blank=True),
+        ),
+    ]
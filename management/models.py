@@ -1,15 +1,38 @@
+import csv
+import hashlib
+import io
+import itertools
+import os
+import tempfile
 import threading
-import time
-from typing import List, Tuple
+import uuid
+from datetime import timedelta
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
 
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
 from django.conf import settings
 from django.contrib.auth.base_user import AbstractBaseUser
-from django.db import models
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.db import connection, models, transaction
+from django.urls import reverse
+from django.utils import timezone
 
-from management.utils import is_valid_sender_email
-from vote.models import Session, Election, Voter
+from management.pdf import TokenSheetPdf
+from management.qr import cached_qr, qr_matrix, qr_png, render_many
+from management.utils import generate_pdf, is_valid_sender_email
+from vote.models import BULK_CREATE_BATCH_SIZE, Session, Election, Voter, voter_cache_key
+from vote.notifications import notify, notify_reload
+from wahlfang import metrics
+
+# number of csv rows that are inserted per transaction by a voter import
+VOTER_IMPORT_CHUNK_SIZE = 500
+# a token sheet reports its progress every time this many QR codes were generated
+TOKEN_SHEET_PROGRESS_INTERVAL = 20
+
+
+def manager_cache_key(manager_id) -> str:
+    return f'manager-{manager_id}'
 
 
 class ElectionManager(AbstractBaseUser):
@@ -24,6 +47,29 @@ class ElectionManager(AbstractBaseUser):
     def __str__(self):
         return f'{self.username}'
 
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        super().save(force_insert, force_update, using, update_fields)
+        cache.delete(manager_cache_key(self.pk))
+
+    def delete(self, using=None, keep_parents=False):
+        pk = self.pk
+        result = super().delete(using, keep_parents)
+        cache.delete(manager_cache_key(pk))
+        return result
+
+    @classmethod
+    def get_cached(cls, pk) -> Optional['ElectionManager']:
+        """
+        Return the manager for authenticating a request or websocket, cached like Voter.get_cached().
+        """
+        manager = cache.get(manager_cache_key(pk))
+        if manager is None:
+            manager = cls.objects.filter(pk=pk).first()
+            if manager is None:
+                return None
+            cache.set(manager_cache_key(pk), manager, timeout=settings.USER_CACHE_TIMEOUT)
+        return manager
+
     @property
     def sender_email(self):
         if self.email and is_valid_sender_email(self.email):
@@ -37,45 +83,456 @@ class ElectionManager(AbstractBaseUser):
     def get_election(self, pk):
         return Election.objects.filter(session__in=self.sessions).filter(pk=pk).first()
 
-    def send_invite_bulk_threaded(self, voters_codes: List[Tuple[Voter, str]]):
-        def runner():
-            failed_voters = list(filter(lambda i: i[0] is not None,
-                                        (voter.send_invitation(code, self.sender_email) for voter, code in
-                                         voters_codes)))
-
-            def wait_heuristic():
-                # heuristic sleep to avoid a channel message before the manager's websocket reconnected
-                # after x send emails this sleep should be unnecessary
-                if len(failed_voters) < 10:
-                    time.sleep(1)
-
-            group = "SessionAlert-" + str(voters_codes[0][0].session.pk)
-            if len(failed_voters) == 0:
-                wait_heuristic()
-                # send message that tells the manager that all emails have been sent successfully
-                async_to_sync(get_channel_layer().group_send)(
-                    group,
-                    {'type': 'send_succ', 'msg': "Emails send successfully!"}
-                )
-                return
-            failed_emails_str = "".join(
-                [f"<tr><td>{voter.email}</td><td>{e}</td></tr>" for voter, e in failed_voters])
-
-            msg = 'The following email addresses failed to send and thus are probably unassigned addresses. ' \
-                  'Please check them again on correctness.<table class="width100"><tr><th>Email</th>' \
-                  '<th>Error</th></tr>{}</table>'
-
-            # delete voters where the email could not be sent
-            for voter, _ in failed_voters:
-                voter.invalid_email = True
-                voter.save()  # may trigger a lot of automatic reloads
-            wait_heuristic()
-            async_to_sync(get_channel_layer().group_send)(
+
+class MailJob(models.Model):
+    """
+    An email to a single voter, sent by the run_workers management command.
+
+    Failed jobs are retried with an exponential backoff. Jobs of a worker that died while sending them are picked up
+    again after MAIL_JOB_TIMEOUT seconds. Invitations issue a fresh access code whenever they are sent, the code is
+    never stored.
+    """
+    INVITATION = 'invitation'
+    REMINDER = 'reminder'
+    KIND_CHOICES = [
+        (INVITATION, 'Invitation'),
+        (REMINDER, 'Reminder'),
+    ]
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Sending'),
+        (DONE, 'Sent'),
+        (FAILED, 'Failed'),
+    ]
+
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+    session = models.ForeignKey(Session, related_name='mail_jobs', on_delete=models.CASCADE)
+    voter = models.ForeignKey(Voter, related_name='mail_jobs', on_delete=models.CASCADE)
+    election = models.ForeignKey(Election, related_name='mail_jobs', null=True, blank=True, on_delete=models.CASCADE)
+    from_email = models.CharField(max_length=254)
+    # jobs enqueued together, the manager is notified once all of them are done
+    batch = models.UUIDField(default=uuid.uuid4)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    # set on all jobs of the batch by the job that reports the batch to the manager
+    batch_notified = models.BooleanField(default=False)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'run_after'], name='mailjob_status_run_after_idx')]
+
+    def __str__(self):
+        return f'{self.get_kind_display()} for {self.voter}'
+
+    @classmethod
+    def enqueue(cls, kind: str, voters: Iterable[Voter], from_email: str, election: Optional[Election] = None,
+                batch: Optional[uuid.UUID] = None) -> uuid.UUID:
+        batch = batch or uuid.uuid4()
+        cls.objects.bulk_create([
+            cls(kind=kind, session_id=voter.session_id, voter=voter, election=election, from_email=from_email,
+                batch=batch)
+            for voter in voters if voter.email
+        ], batch_size=BULK_CREATE_BATCH_SIZE)
+        return batch
+
+    @classmethod
+    def claim(cls) -> Optional['MailJob']:
+        """
+        Take the next due job off the queue, returns None if there is none.
+        """
+        now = timezone.now()
+        # the worker that was sending these died
+        cls.objects.filter(status=cls.RUNNING, updated__lt=now - timedelta(seconds=settings.MAIL_JOB_TIMEOUT)) \
+            .update(status=cls.PENDING, updated=now)
+
+        due = cls.objects.filter(status=cls.PENDING, run_after__lte=now).order_by('run_after')
+        for pk in due.values_list('pk', flat=True)[:20]:
+            # other workers may claim the same job concurrently, only the one whose update matched the row gets it
+            if cls.objects.filter(pk=pk, status=cls.PENDING).update(status=cls.RUNNING, updated=now):
+                return cls.objects.select_related('voter__session', 'election').get(pk=pk)
+        return None
+
+    def send(self, connection=None) -> Optional[str]:
+        """
+        Send the email, returns the error if it could not be sent.
+        """
+        if self.kind == self.INVITATION:
+            # the voter keeps their previous access code if the new one could not be sent
+            with transaction.atomic():
+                access_code = self.voter.new_access_token()
+                _, error = self.voter.send_invitation(access_code, self.from_email, connection=connection)
+                if error is not None:
+                    transaction.set_rollback(True)
+        else:
+            _, error = self.voter.send_reminder(self.from_email, self.election, connection=connection)
+        return error
+
+    def run(self, connection=None):
+        try:
+            error = self.send(connection)
+        except Exception as e:  # pylint: disable=W0703
+            error = str(e)
+
+        self.attempts += 1
+        self.last_error = error or ''
+        if error is None:
+            self.status = self.DONE
+            if self.kind == self.INVITATION and self.voter.invalid_email:
+                self.voter.invalid_email = False
+                self.voter.save(update_fields=['invalid_email'])
+        elif self.attempts < settings.MAIL_JOB_MAX_ATTEMPTS:
+            self.status = self.PENDING
+            delay = settings.MAIL_JOB_RETRY_DELAY * 2 ** (self.attempts - 1)
+            self.run_after = timezone.now() + timedelta(seconds=delay)
+        else:
+            self.status = self.FAILED
+            if self.kind == self.INVITATION:
+                self.voter.invalid_email = True
+                self.voter.save(update_fields=['invalid_email'])
+        self.updated = timezone.now()
+        self.save()
+
+        if self.kind == self.INVITATION:
+            self.report_batch()
+
+    def report_batch(self):
+        """
+        Report the batch to the manager once all of its jobs are done. The batch of a voter import is only reported
+        after its last chunk was imported, the jobs of the first chunks may be done before the next ones are enqueued.
+        """
+        if MailJob.objects.filter(batch=self.batch, status__in=[self.PENDING, self.RUNNING]).exists():
+            return
+        if VoterImport.objects.filter(mail_batch=self.batch, finished=None).exists():
+            return
+        self.notify_batch_result()
+
+    def notify_batch_result(self):
+        # the last jobs of a batch may finish concurrently, only the worker whose update matched the rows reports it
+        if not MailJob.objects.filter(batch=self.batch, batch_notified=False).update(batch_notified=True):
+            return
+        group = "SessionAlert-" + str(self.session_id)
+        failed_jobs = MailJob.objects.filter(batch=self.batch, status=self.FAILED).select_related('voter')
+        if not failed_jobs:
+            # send message that tells the manager that all emails have been sent successfully
+            notify(
                 group,
-                {'type': 'send_alert', 'msg': msg.format(failed_emails_str), 'title': 'Error during email sending',
-                 'reload': '#voterCard'}
+                {'type': 'send_succ', 'msg': "Emails send successfully!"},
+                key=('mail_batch', self.batch)
+            )
+            return
+        failed_emails_str = "".join(
+            [f"<tr><td>{job.voter.email}</td><td>{job.last_error}</td></tr>" for job in failed_jobs])
+
+        msg = 'The following email addresses failed to send and thus are probably unassigned addresses. ' \
+              'Please check them again on correctness.<table class="width100"><tr><th>Email</th>' \
+              '<th>Error</th></tr>{}</table>'
+
+        notify(
+            group,
+            {'type': 'send_alert', 'msg': msg.format(failed_emails_str), 'title': 'Error during email sending',
+             'reload': '#voterCard'},
+            key=('mail_batch', self.batch)
+        )
+
+
+def private_storage():
+    return FileSystemStorage(location=settings.PRIVATE_MEDIA_ROOT)
+
+
+def voter_import_file_name(instance, filename):
+    return os.path.join('voter_imports', str(uuid.uuid4()) + '.csv')
+
+
+class VoterImport(models.Model):
+    """
+    CSV import of voters that is processed in chunks in a background thread.
+
+    The uploaded file is kept until the import is finished. Every chunk of voters is inserted together with the
+    updated number of imported rows, so an import that was interrupted (e.g. by a restart) continues after the last
+    committed chunk when it is resumed with the resume_voter_imports management command.
+    """
+    session = models.ForeignKey(Session, related_name='voter_imports', on_delete=models.CASCADE)
+    manager = models.ForeignKey(ElectionManager, null=True, blank=True, on_delete=models.SET_NULL)
+    csv_file = models.FileField(upload_to=voter_import_file_name, storage=private_storage)
+    total_rows = models.PositiveIntegerField(default=0)
+    imported_rows = models.PositiveIntegerField(default=0)
+    skipped_rows = models.PositiveIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    # the invitations of all chunks are reported to the manager together
+    mail_batch = models.UUIDField(default=uuid.uuid4)
+    # the import stopped with this error, resume_voter_imports continues it
+    error = models.TextField(blank=True)
+
+    def __str__(self):
+        return f'Voter import {self.pk} of {self.session}'
+
+    def rows(self, start=0) -> Iterator[Tuple[Optional[str], str]]:
+        """
+        Stream the (email, name) rows of the uploaded file, starting after the first `start` rows.
+        """
+        with self.csv_file.open('rb') as f:
+            text_file = io.TextIOWrapper(f, encoding='utf-8', newline='')
+            for row in itertools.islice(csv.DictReader(text_file), start, None):
+                yield row['email'] or None, row['name']
+
+    def run(self):
+        if self.error:
+            self.error = ''
+            self.save(update_fields=['error'])
+        try:
+            self.import_rows()
+        except Exception as e:  # pylint: disable=broad-except
+            self.error = str(e) or e.__class__.__name__
+            self.save(update_fields=['error'])
+            notify(
+                "SessionAlert-" + str(self.session_id),
+                {'type': 'send_alert', 'title': 'Error during voter import',
+                 'msg': f'The import stopped after {self.imported_rows} of {self.total_rows} voters.',
+                 'reload': '#backgroundTasks'}
             )
 
+    def import_rows(self):
+        rows = self.rows(self.imported_rows)
+        # the file was validated on upload, but voters with the same email may have been added since
+        existing_emails = self.session.participant_emails()
+        while self.finished is None:
+            chunk = list(itertools.islice(rows, VOTER_IMPORT_CHUNK_SIZE))
+            if not self.import_chunk(chunk, existing_emails):
+                # another worker continued this import
+                return
+            notify(
+                "SessionAlert-" + str(self.session_id),
+                {'type': 'send_progress', 'id': f'voter-import-{self.pk}', 'done': self.imported_rows,
+                 'total': self.total_rows},
+                key=('voter_import', self.pk)
+            )
+
+        # all invitations may have been sent before the last chunk was committed, see MailJob.report_batch()
+        job = MailJob.objects.filter(batch=self.mail_batch).first()
+        if job is not None:
+            job.report_batch()
+
+        self.csv_file.delete(save=False)
+        self.save(update_fields=['csv_file'])
+        msg = f'Imported {self.imported_rows - self.skipped_rows} voters.'
+        if self.skipped_rows:
+            msg += f' Skipped {self.skipped_rows} voters whose email address was added meanwhile.'
+        notify("SessionAlert-" + str(self.session_id), {'type': 'send_succ', 'msg': msg})
+
+    def import_chunk(self, chunk: List[Tuple[Optional[str], str]], existing_emails: Set[str]) -> bool:
+        """
+        Insert the voters of the chunk whose email is not in existing_emails, which is extended by their emails.
+        """
+        with transaction.atomic():
+            # the row lock serializes concurrent workers, only the one that is still at the expected row continues
+            locked = VoterImport.objects.select_for_update().get(pk=self.pk)
+            if locked.imported_rows != self.imported_rows or locked.finished is not None:
+                return False
+
+            rows = [{'email': email, 'name': name} for email, name in chunk if email not in existing_emails]
+            # the invitations issue the access codes
+            voters = [voter for voter, _ in Voter.bulk_from_data(self.session, rows, access_codes=False)]
+            # enqueued in the same transaction, so every imported voter is invited exactly once
+            if self.manager:
+                MailJob.enqueue(MailJob.INVITATION, voters, self.manager.sender_email, batch=self.mail_batch)
+
+            self.imported_rows += len(chunk)
+            self.skipped_rows += len(chunk) - len(rows)
+            if len(chunk) < VOTER_IMPORT_CHUNK_SIZE:
+                self.finished = timezone.now()
+            self.save(update_fields=['imported_rows', 'skipped_rows', 'finished'])
+        existing_emails.update(row['email'] for row in rows if row['email'])
+        return True
+
+    def run_threaded(self):
+        def runner():
+            try:
+                self.run()
+            finally:
+                connection.close()
+
+        thread = threading.Thread(
+            target=runner,
+            args=())
+        thread.start()
+
+
+def token_sheet_file_name(instance, filename):
+    return os.path.join('token_sheets', str(uuid.uuid4()) + '.pdf')
+
+
+class TokenSheet(models.Model):
+    """
+    PDF with the access codes of the anonymous voters of a session, generated in a background thread.
+
+    Generating a sheet issues new access codes to these voters. The PDF is stored together with a fingerprint of
+    everything printed on it, so it can be downloaded again without running LaTeX as long as the session and its
+    voters are unchanged.
+    """
+    session = models.ForeignKey(Session, related_name='token_sheets', on_delete=models.CASCADE)
+    pdf = models.FileField(upload_to=token_sheet_file_name, storage=private_storage, blank=True)
+    fingerprint = models.CharField(max_length=64, blank=True)
+    total = models.PositiveIntegerField(default=0)
+    done = models.PositiveIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True)
+
+    def __str__(self):
+        return f'Token sheet {self.pk} of {self.session}'
+
+    @staticmethod
+    def token_voters(session):
+        return session.participants.filter(email=None, qr=False).order_by('pk')
+
+    @staticmethod
+    def compute_fingerprint(session, voter_passwords: Iterable[Tuple[int, str]]) -> str:
+        data = [settings.URL, settings.TOKEN_SHEET_RENDERER, timezone.get_current_timezone_name(), session.title,
+                str(session.meeting_link), str(session.start_date)]
+        data += [f'{pk}:{password}' for pk, password in voter_passwords]
+        return hashlib.sha256('\n'.join(data).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def current(cls, session) -> Optional['TokenSheet']:
+        """
+        Return the generated sheet of the session if it is still up to date.
+        """
+        sheet = session.token_sheets.exclude(finished=None).filter(error='').order_by('-finished').first()
+        if sheet is None or not sheet.pdf:
+            return None
+        fingerprint = cls.compute_fingerprint(session, cls.token_voters(session).values_list('pk', 'password'))
+        return sheet if sheet.fingerprint == fingerprint else None
+
+    @classmethod
+    def start(cls, session) -> 'TokenSheet':
+        """
+        Return the sheet of the session that is being generated or start generating a new one.
+        """
+        with transaction.atomic():
+            # the session lock makes sure that only one sheet per session is generated at a time
+            Session.objects.select_for_update().get(pk=session.pk)
+            # the thread generating these sheets died, e.g. because the server was restarted
+            session.token_sheets.filter(
+                finished=None, created__lt=timezone.now() - timedelta(seconds=settings.TOKEN_SHEET_TIMEOUT)
+            ).update(finished=timezone.now(), error='Interrupted')
+
+            sheet = session.token_sheets.filter(finished=None).first()
+            if sheet is None:
+                sheet = cls.objects.create(session=session, total=cls.token_voters(session).count() + 1)
+                transaction.on_commit(sheet.run_threaded)
+        return sheet
+
+    def run(self):
+        try:
+            self.generate()
+        except Exception as e:  # pylint: disable=broad-except
+            self.error = str(e) or e.__class__.__name__
+            self.finished = timezone.now()
+            self.save(update_fields=['error', 'finished'])
+            notify(
+                "SessionAlert-" + str(self.session_id),
+                {'type': 'send_alert', 'title': 'Error during token generation',
+                 'msg': 'The token sheet could not be generated, please try again.', 'reload': '#backgroundTasks'}
+            )
+
+    def generate(self):
+        session = self.session
+        voters = list(self.token_voters(session))
+        # one step per QR code and one for the PDF
+        self.total = len(voters) + 1
+        tokens = []
+        for voter in voters:
+            tokens.append(Voter.get_access_code(voter, voter.set_password()))
+            voter.logged_in = False
+        Voter.objects.bulk_update(voters, ['password', 'logged_in'], batch_size=BULK_CREATE_BATCH_SIZE)
+        cache.delete_many([voter_cache_key(voter.pk) for voter in voters])
+        notify_reload("Login-Session-" + str(session.pk), '#voterCard')
+
+        login_urls = [f'https://{settings.URL}' + reverse('vote:link_login', kwargs={'access_code': token})
+                      for token in tokens]
+        if settings.TOKEN_SHEET_RENDERER == 'vector':
+            pdf = self.render_vector(tokens, login_urls)
+        else:
+            pdf = self.render_latex(tokens, login_urls)
+
+        self.pdf.save(token_sheet_file_name(self, None), ContentFile(pdf), save=False)
+        self.fingerprint = self.compute_fingerprint(session, [(voter.pk, voter.password) for voter in voters])
+        self.done = self.total
+        self.finished = timezone.now()
+        self.save()
+        # older sheets contain access codes that are no longer valid
+        for sheet in session.token_sheets.exclude(pk=self.pk):
+            sheet.pdf.delete(save=False)
+            sheet.delete()
+
+        self.send_progress()
+        notify(
+            "SessionAlert-" + str(self.session_id),
+            {'type': 'send_succ', 'msg': 'The token sheet is ready: <a href="{}">Download Tokens</a>'.format(
+                reverse('management:print_token', kwargs={'pk': self.session_id}))}
+        )
+
+    def step(self, done: int):
+        self.done = done
+        if self.done % TOKEN_SHEET_PROGRESS_INTERVAL == 0:
+            self.save(update_fields=['total', 'done'])
+            self.send_progress()
+
+    def render_latex(self, tokens: List[str], login_urls: List[str]) -> bytes:
+        # pdflatex can only include images from files
+        with tempfile.TemporaryDirectory() as qr_dir:
+            meeting_qr_path = None
+            if self.session.meeting_link:
+                meeting_qr_path = os.path.join(qr_dir, 'qr_meeting.png')
+                with open(meeting_qr_path, 'wb') as f:
+                    f.write(cached_qr(qr_png, self.session.meeting_link))
+
+            zipped = []
+            for idx, (token, png) in enumerate(zip(tokens, render_many(qr_png, login_urls))):
+                path = os.path.join(qr_dir, 'qr_{}.png'.format(idx))
+                with open(path, 'wb') as f:
+                    f.write(png)
+                zipped.append({'path': path, 'token': token})
+                self.step(idx + 1)
+
+            context = {
+                'session': self.session,
+                'tokens': zipped,
+                'meeting_link_qr': meeting_qr_path
+            }
+            return bytes(generate_pdf('vote/tex/invitation.tex', context, qr_dir))
+
+    def render_vector(self, tokens: List[str], login_urls: List[str]) -> bytes:
+        sheet = TokenSheetPdf(self.session)
+        for idx, (token, matrix) in enumerate(zip(tokens, render_many(qr_matrix, login_urls))):
+            sheet.add_invitation(token, matrix)
+            self.step(idx + 1)
+        with metrics.PDF_BUILD_SECONDS.labels('vector').time():
+            return sheet.build()
+
+    def send_progress(self):
+        notify(
+            "SessionAlert-" + str(self.session_id),
+            {'type': 'send_progress', 'id': f'token-sheet-{self.pk}', 'done': self.done, 'total': self.total},
+            key=('token_sheet', self.pk)
+        )
+
+    def run_threaded(self):
+        def runner():
+            try:
+                self.run()
+            finally:
+                connection.close()
+
         thread = threading.Thread(
             target=runner,
             args=())
@@ -0,0 +1,204 @@
+"""
+Minimal PDF writer for the token sheets.
+
+The sheets only need text in the standard PDF fonts and QR codes, which are drawn as vector paths straight from the
+module matrix of the QR code. This avoids the PNG files and the pdflatex run of the LaTeX template.
+"""
+import zlib
+from functools import lru_cache
+from typing import Optional, Sequence, Tuple
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.formats import date_format
+
+from management.qr import cached_qr, qr_matrix
+
+# A4 in points
+PAGE_WIDTH = 595.28
+PAGE_HEIGHT = 841.89
+CM = 72 / 2.54
+MARGIN_LEFT = 3 * CM
+MARGIN_RIGHT = 3 * CM
+MARGIN_TOP = 3 * CM
+QR_SIZE = 3.4 * CM
+
+# advance widths of the printable ASCII characters of Helvetica in 1/1000 of the font size (from the Adobe AFM file)
+_HELVETICA_WIDTHS = [
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+    1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+    333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+    556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584,
+]
+
+
+def text_width(text: str, size: float) -> float:
+    return sum(_HELVETICA_WIDTHS[ord(c) - 32] if 32 <= ord(c) < 127 else 556 for c in text) * size / 1000
+
+
+@lru_cache(maxsize=256)
+def wrap(text: str, size: float, width: float) -> Tuple[str, ...]:
+    """
+    Split `text` into lines that fit into `width`. Cached, because most paragraphs are the same on every invitation.
+    """
+    lines = []
+    line = ''
+    for word in text.split():
+        candidate = f'{line} {word}' if line else word
+        if line and text_width(candidate, size) > width:
+            lines.append(line)
+            line = word
+        else:
+            line = candidate
+    return tuple(lines + [line] if line else lines)
+
+
+def qr_path(matrix: Sequence[Sequence[bool]]) -> bytes:
+    """
+    Fill operators that draw a QR code into the unit square, one rectangle per run of dark modules.
+    """
+    module = 1 / len(matrix)
+    rects = []
+    for row, modules in enumerate(matrix):
+        top = 1 - (row + 1) * module
+        start = None
+        for col, dark in enumerate(list(modules) + [False]):
+            if dark and start is None:
+                start = col
+            elif not dark and start is not None:
+                rects.append(b'%.5f %.5f %.5f %.5f re' % (start * module, top, (col - start) * module, module))
+                start = None
+    return b'\n'.join(rects) + b' f'
+
+
+def _pdf_string(text: str) -> bytes:
+    encoded = text.encode('cp1252', errors='replace')
+    return b'(' + encoded.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)') + b')'
+
+
+class PdfDocument:
+    """
+    Pages of drawing operators, written as a PDF with the fonts Helvetica (F1), Helvetica-Bold (F2) and
+    ZapfDingbats (F3).
+    """
+
+    def __init__(self):
+        self.pages = []
+        self.ops = None
+
+    def new_page(self):
+        self.ops = []
+        self.pages.append(self.ops)
+
+    def text(self, x: float, y: float, text: str, size: float = 10, font: str = 'F1'):
+        self.ops.append(b'BT /%s %.2f Tf %.2f %.2f Td %s Tj ET' % (font.encode(), size, x, y, _pdf_string(text)))
+
+    def line(self, x1: float, y1: float, x2: float, y2: float, dash: Optional[float] = None):
+        dash_op = b'[%.2f] 0 d ' % dash if dash else b''
+        self.ops.append(b'q %s0.5 w %.2f %.2f m %.2f %.2f l S Q' % (dash_op, x1, y1, x2, y2))
+
+    def qr_code(self, x: float, y: float, size: float, path: bytes):
+        """
+        Draw a QR code path (see qr_path()) with its lower left corner at (x, y).
+        """
+        self.ops.append(b'q %.3f 0 0 %.3f %.3f %.3f cm %s Q' % (size, size, x, y, path))
+
+    def build(self) -> bytes:
+        fonts = b'<< /F1 3 0 R /F2 4 0 R /F3 5 0 R >>'
+        objects = [
+            b'<< /Type /Catalog /Pages 2 0 R >>',
+            b'<< /Type /Pages /Kids [%s] /Count %d >>' % (
+                b' '.join(b'%d 0 R' % (6 + 2 * i) for i in range(len(self.pages))), len(self.pages)),
+            b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>',
+            b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold /Encoding /WinAnsiEncoding >>',
+            b'<< /Type /Font /Subtype /Type1 /BaseFont /ZapfDingbats >>',
+        ]
+        for i, ops in enumerate(self.pages):
+            content = zlib.compress(b'\n'.join(ops))
+            objects.append(b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.2f %.2f] /Resources << /Font %s >> '
+                           b'/Contents %d 0 R >>' % (PAGE_WIDTH, PAGE_HEIGHT, fonts, 7 + 2 * i))
+            objects.append(b'<< /Length %d /Filter /FlateDecode >>\nstream\n%s\nendstream' % (len(content), content))
+
+        out = bytearray(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+        offsets = []
+        for number, body in enumerate(objects, 1):
+            offsets.append(len(out))
+            out += b'%d 0 obj\n%s\nendobj\n' % (number, body)
+        xref = len(out)
+        out += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+        out += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+        out += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+        return bytes(out)
+
+
+class TokenSheetPdf:
+    """
+    Token sheet with the same layout as the LaTeX template vote/tex/invitation.tex: two invitations per page,
+    separated by a cut-here line.
+    """
+    size = 10
+
+    def __init__(self, session):
+        self.session = session
+        self.document = PdfDocument()
+        self.count = 0
+        self.width = PAGE_WIDTH - MARGIN_LEFT - MARGIN_RIGHT
+        self.meeting_qr = qr_path(cached_qr(qr_matrix, session.meeting_link)) if session.meeting_link else None
+        self.details = [f'Title: {session.title}']
+        if session.meeting_link:
+            self.details.append(f'Meeting room: {session.meeting_link}')
+        if session.start_date:
+            start_date = date_format(timezone.localtime(session.start_date), 'DATETIME_FORMAT')
+            self.details.append(f'Start date: {start_date}')
+
+    def paragraph(self, y: float, text: str, size: float) -> float:
+        for line in wrap(text, size, self.width):
+            self.document.text(MARGIN_LEFT, y, line, size)
+            y -= size * 1.3
+        return y
+
+    def add_invitation(self, access_code: str, login_qr: Sequence[Sequence[bool]]):
+        """
+        Add the invitation of an access code, login_qr is the QR matrix of its login url (see management.qr).
+        """
+        document = self.document
+        if self.count % 2 == 0:
+            document.new_page()
+            y = PAGE_HEIGHT - MARGIN_TOP
+        else:
+            # cut here
+            document.text(MARGIN_LEFT, PAGE_HEIGHT / 2 - 3, '"', size=10, font='F3')
+            document.line(MARGIN_LEFT + 12, PAGE_HEIGHT / 2, PAGE_WIDTH - MARGIN_RIGHT, PAGE_HEIGHT / 2, dash=1)
+            y = PAGE_HEIGHT / 2 - CM
+        self.count += 1
+
+        y -= 14
+        document.text(MARGIN_LEFT, y, 'Invitation to Participate in an Online Election', size=14, font='F2')
+        y -= 22
+        y = self.paragraph(y, 'You have been invited to attend the following online election session:', self.size)
+        y -= 6
+        for line in self.details + [f'Access token: {access_code}']:
+            y = self.paragraph(y, line, self.size)
+        y -= 6
+        y = self.paragraph(y, 'Access to the election session can be gained by either entering the access token in '
+                              f'https://{settings.URL} or by scanning the following QR-Code:', self.size)
+
+        y -= 8 + QR_SIZE
+        codes = [('(a) Meeting Link', self.meeting_qr), ('(b) Voting Link', qr_path(login_qr))] \
+            if self.meeting_qr else [('Voting Link', qr_path(login_qr))]
+        figure_width = len(codes) * QR_SIZE + (len(codes) - 1) * CM
+        x = MARGIN_LEFT + (self.width - figure_width) / 2
+        for caption, path in codes:
+            document.qr_code(x, y, QR_SIZE, path)
+            document.text(x + (QR_SIZE - text_width(caption, 9)) / 2, y - 12, caption, size=9)
+            x += QR_SIZE + CM
+        y -= 12 + 14
+
+        self.paragraph(y, 'Wahlfang is an open source online voting system developed and hosted by StuStaNet. If you '
+                          'have any questions or want to help expanding the feature set feel free to contact us: '
+                          'admins@stusta.de', self.size)
+
+    def build(self) -> bytes:
+        return self.document.build()
@@ -0,0 +1,68 @@
+"""
+QR codes of login and meeting links, rendered in memory.
+
+The render functions only depend on the qrcode library, so batches can be rendered in worker processes that don't set
+up Django.
+"""
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from io import BytesIO
+from typing import Callable, Iterable, Iterator, Tuple, TypeVar
+
+import qrcode
+import qrcode.image.svg
+from django.conf import settings
+
+T = TypeVar('T')
+
+# smaller batches are rendered in the calling thread, starting the worker processes would take longer
+QR_PARALLEL_MIN_BATCH = 50
+
+
+def qr_matrix(data: str) -> Tuple[Tuple[bool, ...], ...]:
+    """
+    Modules of the QR code of `data` including the quiet zone, True for dark modules.
+    """
+    qr = qrcode.QRCode()
+    qr.add_data(data)
+    qr.make(fit=True)
+    return tuple(tuple(row) for row in qr.get_matrix())
+
+
+def qr_png(data: str) -> bytes:
+    buffered = BytesIO()
+    qrcode.make(data).save(buffered, 'PNG')
+    return buffered.getvalue()
+
+
+def qr_svg(data: str) -> bytes:
+    buffered = BytesIO()
+    qrcode.make(data, image_factory=qrcode.image.svg.SvgPathFillImage).save(buffered)
+    return buffered.getvalue()
+
+
+@lru_cache(maxsize=32)
+def cached_qr(renderer: Callable[[str], T], data: str) -> T:
+    """
+    QR code of data that is rendered again and again, like the meeting link of a session.
+    """
+    return renderer(data)
+
+
+def render_many(renderer: Callable[[str], T], items: Iterable[str]) -> Iterator[T]:
+    """
+    Render the QR codes of many items, yielded in order as soon as they are ready.
+
+    Large batches are distributed over QR_RENDER_PROCESSES worker processes (all cores by default).
+    """
+    items = list(items)
+    processes = settings.QR_RENDER_PROCESSES or os.cpu_count() or 1
+    if processes <= 1 or len(items) < QR_PARALLEL_MIN_BATCH:
+        yield from map(renderer, items)
+        return
+
+    # the workers are spawned instead of forked, forking a threaded server process isn't safe
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn')) as pool:
+        yield from pool.map(renderer, items, chunksize=max(1, len(items) // (4 * processes)))
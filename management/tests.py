@@ -0,0 +1,313 @@
+import itertools
+import re
+from io import StringIO
+from unittest import mock
+
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.core import mail
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import DatabaseError, connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from management.consumers import ElectionConsumer, SessionConsumer
+from management.forms import AddVotersForm, CSVUploaderForm
+from management.models import ElectionManager, MailJob, TokenSheet, VoterImport
+from management.qr import qr_matrix, render_many
+from vote.authentication import AccessCodeBackend
+from vote.consumers import VoteConsumer
+from vote.forms import VoteForm
+from vote.hashers import AccessCodeHasher
+from vote.models import Application, Election, Session, Voter, VOTE_ACCEPT
+from wahlfang import metrics
+
+
+class ManagerConsumerTest(TestCase):
+    # database_sync_to_async would close the connection of the test transaction
+    @mock.patch('channels.db.close_old_connections')
+    def test_manager_receives_counters(self, _):
+        session = Session.objects.create(title='TEST')
+        election = Election.objects.create(session=session, start_date=timezone.now())
+        application = Application.objects.create(election=election, display_name='candidate')
+        voter, _ = Voter.from_data(session=session)
+        Voter.from_data(session=session)
+        request = RequestFactory().post('/')
+        request.user = voter
+        form = VoteForm(request, election=election, data={str(application.pk): VOTE_ACCEPT})
+        self.assertTrue(form.is_valid(), form.errors)
+
+        async def vote():
+            communicator = WebsocketCommunicator(ElectionConsumer.as_asgi(), f'/management/election/{election.pk}')
+            communicator.scope['url_route'] = {'kwargs': {'pk': str(election.pk)}}
+            await communicator.connect()
+            await sync_to_async(form.save)()
+            message = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return message
+
+        self.assertEqual(async_to_sync(vote)(), {'counters': {'voters': 2, 'cast': 1, 'open': 1}})
+
+    @mock.patch('channels.db.close_old_connections')
+    def test_connected_voters(self, _):
+        session = Session.objects.create(title='TEST')
+        voter = Voter.objects.select_related('session').get(pk=Voter.objects.create(session=session).pk)
+
+        async def receive_counters(communicator):
+            # skip the election cards of other tests that are still pending
+            while True:
+                message = await communicator.receive_json_from()
+                if 'counters' in message:
+                    return message
+
+        async def connect_and_disconnect():
+            manager = WebsocketCommunicator(SessionConsumer.as_asgi(), f'/management/meeting/{session.pk}')
+            manager.scope['url_route'] = {'kwargs': {'pk': str(session.pk)}}
+            await manager.connect()
+            sizes = [metrics.group_size(f'Session-{session.pk}')]
+
+            communicator = WebsocketCommunicator(VoteConsumer.as_asgi(), '/')
+            communicator.scope.update({'user': voter, 'url_route': {'kwargs': {}}})
+            await communicator.connect()
+            sizes.append(metrics.group_size(f'Session-{session.pk}'))
+            updates = [await receive_counters(manager)]
+            await communicator.disconnect()
+            updates.append(await receive_counters(manager))
+            await manager.disconnect()
+            return sizes, updates
+
+        sizes, updates = async_to_sync(connect_and_disconnect)()
+        self.assertEqual(sizes, [1, 2])
+        self.assertEqual(updates, [{'counters': {'connected_voters': 1}}, {'counters': {'connected_voters': 0}}])
+        self.assertEqual(metrics.group_size(f'Session-{session.pk}'), 0)
+
+
+class VoterImportTest(TestCase):
+    def setUp(self):
+        self.session = Session.objects.create(title='TEST')
+        Voter.from_data(session=self.session, email='existing@example.com')
+        Voter.from_data(session=self.session)
+
+    def test_csv_conflicts(self):
+        csv_data = ('email,name\n'
+                    'a@example.com,A\n'
+                    'existing@example.com,Existing\n'
+                    ',Anonymous\n'
+                    'a@example.com,A again\n'
+                    ',Anonymous 2\n').encode()
+        with CaptureQueriesContext(connection) as queries:
+            form = CSVUploaderForm(self.session, data={}, files={
+                'csv_data': SimpleUploadedFile('voters.csv', csv_data)
+            })
+            self.assertFalse(form.is_valid())
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(form.errors['csv_data'], [
+            'Line 3: Voter with email address existing@example.com already exists',
+            'Line 5: Duplicate email in csv: a@example.com, already on line 2',
+        ])
+
+    @mock.patch('management.models.VOTER_IMPORT_CHUNK_SIZE', 2)
+    def test_csv_import_resumes(self):
+        csv_data = 'email,name\n' + ''.join(f'voter{i}@example.com,Voter {i}\n' for i in range(5)) + ',Anonymous\n'
+        voter_import = VoterImport.objects.create(session=self.session, total_rows=6,
+                                                  csv_file=ContentFile(csv_data.encode(), name='voters.csv'))
+        # the first chunk was committed before the worker died
+        voter_import.import_chunk(list(itertools.islice(voter_import.rows(), 2)), self.session.participant_emails())
+        Voter.from_data(session=self.session, email='voter3@example.com')
+
+        voter_import = VoterImport.objects.get(pk=voter_import.pk)
+        voter_import.run()
+
+        voter_import.refresh_from_db()
+        self.assertIsNotNone(voter_import.finished)
+        self.assertEqual((voter_import.imported_rows, voter_import.skipped_rows), (6, 1))
+        self.assertEqual(self.session.participants.count(), 2 + 6)
+        self.assertFalse(voter_import.csv_file)
+
+    @mock.patch('management.models.VOTER_IMPORT_CHUNK_SIZE', 2)
+    def test_mail_batch_reported_once_after_resume(self):
+        manager = ElectionManager.objects.create(username='manager')
+        csv_data = 'email,name\n' + ''.join(f'voter{i}@example.com,Voter {i}\n' for i in range(5))
+        voter_import = VoterImport.objects.create(session=self.session, manager=manager, total_rows=5,
+                                                  csv_file=ContentFile(csv_data.encode(), name='voters.csv'))
+
+        def reports():
+            return [call for call in notify.call_args_list
+                    if call.kwargs.get('key') == ('mail_batch', voter_import.mail_batch)]
+
+        with mock.patch('management.models.notify') as notify:
+            # the first chunk was committed and its invitations were sent before the worker died
+            voter_import.import_chunk(list(itertools.islice(voter_import.rows(), 2)), self.session.participant_emails())
+            call_command('run_workers', concurrency=1, once=True, stdout=StringIO())
+            self.assertEqual(len(mail.outbox), 2)
+            self.assertEqual(reports(), [])
+
+            VoterImport.objects.get(pk=voter_import.pk).run()
+            call_command('run_workers', concurrency=1, once=True, stdout=StringIO())
+
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(len(reports()), 1)
+        self.assertEqual(reports()[0].args[1]['type'], 'send_succ')
+
+    def test_csv_import_error(self):
+        csv_data = 'email,name\nvoter@example.com,Voter\n'
+        voter_import = VoterImport.objects.create(session=self.session, total_rows=1,
+                                                  csv_file=ContentFile(csv_data.encode(), name='voters.csv'))
+        with mock.patch.object(Voter, 'bulk_from_data', side_effect=DatabaseError('disk full')), \
+                mock.patch('management.models.notify') as notify:
+            voter_import.run()
+
+        voter_import.refresh_from_db()
+        self.assertEqual((voter_import.error, voter_import.finished), ('disk full', None))
+        self.assertEqual(notify.call_args.args[1]['type'], 'send_alert')
+
+        # continued by resume_voter_imports
+        call_command('resume_voter_imports', stdout=StringIO())
+        voter_import.refresh_from_db()
+        self.assertEqual(voter_import.error, '')
+        self.assertIsNotNone(voter_import.finished)
+        self.assertTrue(self.session.participants.filter(email='voter@example.com').exists())
+
+    def test_voters_list_conflicts(self):
+        form = AddVotersForm(self.session, data={
+            'voters_list': 'a@example.com\nexisting@example.com\n\na@example.com\nb@example.com'
+        })
+        self.assertFalse(form.is_valid())
+        self.assertEqual(form.errors['voters_list'], [
+            'line 2: a voter with email address existing@example.com already exists',
+            'line 4: duplicate email address a@example.com, already on line 1',
+        ])
+
+
+class TokenSheetTest(TestCase):
+    def setUp(self):
+        self.session = Session.objects.create(title='TEST', meeting_link='https://meet.example.com')
+        Voter.bulk_from_data(self.session, [{}, {}, {'email': 'voter@example.com'}])
+
+    @mock.patch('management.models.generate_pdf', return_value=b'%PDF-1.4')
+    def test_sheet_is_reused(self, generate_pdf):
+        sheet = TokenSheet.start(self.session)
+        self.assertEqual(TokenSheet.start(self.session), sheet)
+        sheet.run()
+
+        self.assertEqual(TokenSheet.current(self.session), sheet)
+        with sheet.pdf.open('rb') as f:
+            self.assertEqual(f.read(), b'%PDF-1.4')
+        tokens = [token['token'] for token in generate_pdf.call_args[0][1]['tokens']]
+        self.assertEqual(len(tokens), 2)
+        for token in tokens:
+            self.assertTrue(AccessCodeBackend().authenticate(None, access_code=token).is_anonymous)
+
+        # a new voter isn't on the sheet yet
+        Voter.from_data(session=self.session)
+        self.assertIsNone(TokenSheet.current(self.session))
+        new_sheet = TokenSheet.start(self.session)
+        new_sheet.run()
+        self.assertEqual(TokenSheet.current(self.session), new_sheet)
+        self.assertEqual(list(self.session.token_sheets.all()), [new_sheet])
+        self.assertEqual(generate_pdf.call_count, 2)
+        new_sheet.pdf.delete()
+
+    @override_settings(TOKEN_SHEET_RENDERER='vector')
+    def test_vector_renderer(self):
+        for _ in range(2):
+            Voter.from_data(session=self.session)
+        sheet = TokenSheet.start(self.session)
+        sheet.run()
+        with sheet.pdf.open('rb') as f:
+            pdf = f.read()
+        sheet.pdf.delete()
+        self.assertTrue(pdf.startswith(b'%PDF-1.4'))
+        # four invitations, two per page
+        self.assertEqual(pdf.count(b'/Type /Page '), 2)
+        # the cross-reference table points to the objects
+        xref = int(pdf.rsplit(b'startxref\n', 1)[1].split()[0])
+        offsets = [int(line.split()[0]) for line in pdf[xref:].split(b'\n')[3:3 + pdf.count(b' 0 obj\n')]]
+        for number, offset in enumerate(offsets, 1):
+            self.assertTrue(pdf[offset:].startswith(b'%d 0 obj' % number))
+
+    @override_settings(QR_RENDER_PROCESSES=2)
+    @mock.patch('management.qr.QR_PARALLEL_MIN_BATCH', 2)
+    def test_render_qr_codes_in_processes(self):
+        links = [f'https://example.com/code/{i}' for i in range(4)]
+        self.assertEqual(list(render_many(qr_matrix, links)), [qr_matrix(link) for link in links])
+
+
+class MailJobTest(TestCase):
+    def setUp(self):
+        self.session = Session.objects.create(title='TEST')
+        self.voters = [voter for voter, _ in Voter.bulk_from_data(self.session, [
+            {'email': f'voter{i}@example.com'} for i in range(3)
+        ] + [{}])]
+
+    @override_settings(MAIL_MESSAGES_PER_CONNECTION=2)
+    def test_send_invitations(self):
+        MailJob.enqueue(MailJob.INVITATION, self.voters, 'sender@example.com')
+        self.assertEqual(MailJob.objects.count(), 3)
+
+        with mock.patch('management.utils.get_connection', wraps=mail.get_connection) as get_connection:
+            call_command('run_workers', concurrency=1, once=True, stdout=StringIO())
+
+        # the connection to the mail server is reused
+        self.assertEqual(get_connection.call_count, 2)
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertFalse(MailJob.objects.exclude(status=MailJob.DONE).exists())
+        # the invitation contains the access code issued when it was sent
+        voter = Voter.objects.get(email=mail.outbox[0].to[0])
+        access_code = re.search(r'[0-9a-z]{6}-[0-9a-z]{6}-[0-9a-z]{6}-[0-9a-z]{6}', mail.outbox[0].body).group(0)
+        self.assertEqual(AccessCodeBackend().authenticate(None, access_code=access_code), voter)
+
+    @override_settings(MAIL_JOB_MAX_ATTEMPTS=2)
+    def test_retry_and_fail(self):
+        MailJob.enqueue(MailJob.INVITATION, self.voters[:1], 'sender@example.com')
+        with mock.patch('vote.models.send_mail', side_effect=ConnectionRefusedError('connection refused')):
+            call_command('run_workers', concurrency=1, once=True, stdout=StringIO())
+            job = MailJob.objects.get()
+            self.assertEqual((job.status, job.attempts), (MailJob.PENDING, 1))
+            self.assertGreater(job.run_after, timezone.now())
+
+            MailJob.objects.update(run_after=timezone.now())
+            call_command('run_workers', concurrency=1, once=True, stdout=StringIO())
+        job = MailJob.objects.select_related('voter').get()
+        self.assertEqual((job.status, job.attempts, job.last_error), (MailJob.FAILED, 2, 'connection refused'))
+        self.assertTrue(job.voter.invalid_email)
+
+    def test_failed_invitation_keeps_access_code(self):
+        voter, access_code = Voter.from_data(self.session, email='invited@example.com')
+        MailJob.enqueue(MailJob.INVITATION, [voter], 'sender@example.com')
+        with mock.patch('vote.models.send_mail', side_effect=ConnectionRefusedError('connection refused')):
+            call_command('run_workers', concurrency=1, once=True, stdout=StringIO())
+        # the code that could not be sent was not issued
+        self.assertEqual(AccessCodeBackend().authenticate(None, access_code=access_code), voter)
+
+        MailJob.objects.update(run_after=timezone.now())
+        call_command('run_workers', concurrency=1, once=True, stdout=StringIO())
+        new_code = re.search(r'[0-9a-z]{6}-[0-9a-z]{6}-[0-9a-z]{6}-[0-9a-z]{6}', mail.outbox[0].body).group(0)
+        self.assertEqual(AccessCodeBackend().authenticate(None, access_code=new_code), voter)
+        self.assertIsNone(AccessCodeBackend().authenticate(None, access_code=access_code))
+
+    def test_invitation_hashes_access_code_once(self):
+        manager = ElectionManager.objects.create(username='manager')
+        manager.sessions.add(self.session)
+        form = AddVotersForm(self.session, data={'voters_list': 'a@example.com\nb@example.com'})
+        self.assertTrue(form.is_valid(), form.errors)
+        with mock.patch.object(AccessCodeHasher, 'encode', autospec=True,
+                               side_effect=AccessCodeHasher.encode) as encode:
+            voters = form.save()
+            self.assertFalse(any(voter.has_usable_password() for voter in voters))
+            call_command('run_workers', concurrency=1, once=True, stdout=StringIO())
+        self.assertEqual(encode.call_count, 2)
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_batch_notified_once(self):
+        MailJob.enqueue(MailJob.INVITATION, self.voters[:2], 'sender@example.com')
+        MailJob.objects.update(status=MailJob.DONE)
+        first, second = MailJob.objects.all()
+        with mock.patch('management.models.notify') as notify:
+            # e.g. the last two jobs finished concurrently in two workers
+            first.notify_batch_result()
+            second.notify_batch_result()
+        self.assertEqual(notify.call_count, 1)
@@ -1,4 +1,13 @@
+import threading
+import time
+from typing import Dict
+
 from django.conf import settings
+from django.core.mail import get_connection
+from django.template.loader import get_template
+from latex.build import PdfLatexBuilder
+
+from wahlfang import metrics
 
 
 def is_valid_sender_email(email: str) -> bool:
@@ -6,3 +15,65 @@ def is_valid_sender_email(email: str) -> bool:
         return False
 
     return email.split('@')[-1] in settings.VALID_MANAGER_EMAIL_DOMAINS
+
+
+class MailConnectionPool:
+    """
+    Mail connection that is reused for many messages instead of connecting, starting TLS and logging in for every
+    single message. The connection is renewed after MAIL_MESSAGES_PER_CONNECTION messages.
+
+    Not thread-safe, use one pool per thread.
+    """
+
+    def __init__(self):
+        self.connection = None
+        self.sent = 0
+
+    def get(self):
+        """
+        Return the connection for the next message. It is opened lazily by the caller (EmailBackend.open() is a no-op
+        if the connection is open already), so connection errors are reported for the message that was being sent.
+        """
+        if self.connection is None or self.sent >= settings.MAIL_MESSAGES_PER_CONNECTION:
+            self.close()
+            self.connection = get_connection()
+        self.sent += 1
+        return self.connection
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:  # pylint: disable=W0703
+                # the connection is dropped anyway
+                pass
+        self.connection = None
+        self.sent = 0
+
+
+class RateLimiter:
+    """
+    Limit the rate of an action across all threads of the process, `rate` is the number of actions per second.
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        time.sleep(start - now)
+
+
+def generate_pdf(template_name: str, context: Dict, tex_path: str):
+    template = get_template(template_name).render(context).encode('utf8')
+    with metrics.PDF_BUILD_SECONDS.labels('latex').time():
+        pdf = PdfLatexBuilder(pdflatex='pdflatex').build_pdf(
+            template, texinputs=[tex_path, ''])
+    return pdf
@@ -1,26 +1,20 @@
 import base64
 import csv
-from io import BytesIO
 import logging
-import os
 from argparse import Namespace
 from functools import partial
-from pathlib import Path
-from typing import Dict
 
-import qrcode
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import views as auth_views
-from django.http import Http404, HttpResponse
+from django.db.models import Count
+from django.http import FileResponse, Http404, HttpResponse
 from django.http.response import HttpResponseNotFound
 from django.shortcuts import render, redirect, resolve_url
-from django.template.loader import get_template
 from django.urls import reverse
 from django.utils import timezone
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_protect
-from latex.build import PdfLatexBuilder
 from ratelimit.decorators import ratelimit
 
 from management.authentication import management_login_required
@@ -35,8 +29,11 @@ from management.forms import (
     CSVUploaderForm,
     SessionSettingsForm
 )
+from management.models import MailJob, TokenSheet
+from management.qr import qr_svg
 from vote.models import Election, Application, Voter
-from vote.selectors import open_elections, upcoming_elections, published_elections, closed_elections
+from vote.notifications import connected_voters
+from vote.selectors import partition_elections
 
 logger = logging.getLogger('management.view')
 
@@ -96,14 +93,18 @@ def index(request):
 def session_detail(request, pk=None):
     manager = request.user
     session = manager.sessions.get(id=pk)
+    elections = partition_elections(session)
     context = {
         'session': session,
-        'existing_elections': (session.elections.count() > 0),
-        'open_elections': open_elections(session),
-        'upcoming_elections': upcoming_elections(session),
-        'published_elections': published_elections(session),
-        'closed_elections': closed_elections(session),
-        'voters': session.participants.all()
+        'existing_elections': any(elections.values()),
+        'open_elections': elections['open'],
+        'upcoming_elections': elections['upcoming'],
+        'published_elections': elections['published'],
+        'closed_elections': elections['closed'],
+        'voters': session.participants.all(),
+        'connected_voters': connected_voters(session.pk),
+        'voter_imports': session.voter_imports.filter(finished=None, error=''),
+        'token_sheets': session.token_sheets.filter(finished=None),
     }
     return render(request, template_name='management/session.html', context=context)
 
@@ -200,6 +201,33 @@ def add_voters(request, pk):
     return render(request, template_name='management/add_voters.html', context=context)
 
 
+@management_login_required
+def mail_jobs(request, pk):
+    manager = request.user
+    session = manager.sessions.get(pk=pk)
+
+    if request.POST and request.POST.get('action') == 'retry':
+        session.mail_jobs.filter(status=MailJob.FAILED).update(
+            status=MailJob.PENDING, attempts=0, run_after=timezone.now(), updated=timezone.now(), batch_notified=False)
+        return redirect('management:mail_jobs', pk=pk)
+
+    counts = {(row['kind'], row['status']): row['count']
+              for row in session.mail_jobs.values('kind', 'status').annotate(count=Count('pk'))}
+    context = {
+        'session': session,
+        'statuses': [label for _, label in MailJob.STATUS_CHOICES],
+        'counts': [
+            (kind_label, [counts.get((kind, status), 0) for status, _ in MailJob.STATUS_CHOICES])
+            for kind, kind_label in MailJob.KIND_CHOICES
+        ],
+        # failed jobs and jobs that are waiting for a retry
+        'problems': session.mail_jobs.filter(status__in=[MailJob.PENDING, MailJob.FAILED]).exclude(last_error='')
+                           .select_related('voter', 'election').order_by('-updated')[:100],
+        'failed': session.mail_jobs.filter(status=MailJob.FAILED).exists(),
+    }
+    return render(request, template_name='management/mail_jobs.html', context=context)
+
+
 @management_login_required
 def add_tokens(request, pk):
     manager = request.user
@@ -234,6 +262,7 @@ def election_detail(request, pk):
         'election': election,
         'session': session,
         'applications': election.applications.all(),
+        'vote_counters': election.vote_counters(),
         'stop_election_form': StopElectionForm(instance=election),
         'start_election_form': StartElectionForm(instance=election),
     }
@@ -250,9 +279,8 @@ def election_detail(request, pk):
         if form.is_valid():
             form.save()
             if election.send_emails_on_start:
-                for voter in session.participants.all():
-                    voter.send_reminder(
-                        session.managers.all().first().sender_email, election)
+                MailJob.enqueue(MailJob.REMINDER, session.participants.all(),
+                                session.managers.all().first().sender_email, election)
         else:
             context['start_election_form'] = form
 
@@ -378,24 +406,21 @@ def add_mobile_voter_post(request, pk):
 
     if request.POST.get("cancel"):
         # delete the just created voter if manager cancels
-        voter = session.participants.filter(pk=int(request.POST.get("cancel")))
-        if not voter.exists():
+        voter = session.participants.filter(pk=int(request.POST.get("cancel"))).first()
+        if voter is None:
             messages.add_message(request, messages.ERROR,
                                 'Error: Could not delete QR code participant!')
         else:
+            # also resets the vote counters and drops the voter from the user cache
             voter.delete()
         return redirect('management:session', pk=session.pk)
 
     name = request.POST.get("name")
     voter, access_code = Voter.from_data(session=session, qr=True, name=name)
     link = f'https://{settings.URL}' + reverse('vote:link_login', kwargs={'access_code': access_code})
-    img = qrcode.make(link)
-
-    buffered = BytesIO()
-    img.save(buffered, "PNG")
     context = {
         'session': session,
-        'qr': base64.b64encode(buffered.getvalue()).decode('utf-8'),
+        'qr': base64.b64encode(qr_svg(link)).decode('utf-8'),
         'voter': voter.pk,
         'name': name,
         'link': link,
@@ -409,52 +434,21 @@ def print_token(request, pk):
     if not session.exists():
         return HttpResponseNotFound('Session does not exist')
     session = session.first()
-    participants = session.participants
-    tokens = [participant.new_access_token()
-              for participant in participants.all() if participant.is_anonymous and not participant.qr]
-    if len(tokens) == 0:
+
+    sheet = TokenSheet.current(session)
+    if sheet is not None:
+        return FileResponse(sheet.pdf.open('rb'), as_attachment=True, filename='tokenlist.pdf',
+                            content_type='application/pdf')
+
+    if not TokenSheet.token_voters(session).exists():
         messages.add_message(request, messages.ERROR,
                              'No tokens have yet been generated.')
         return redirect('management:session', pk=session.pk)
 
-    img = [qrcode.make(f'https://{settings.URL}' + reverse('vote:link_login', kwargs={'access_code': access_code}))
-           for access_code in tokens]
-    tmp_qr_path = '/tmp/wahlfang/qr_codes/session_{}'.format(session.pk)
-    Path(tmp_qr_path).mkdir(parents=True, exist_ok=True)
-    if session.meeting_link:
-        meeting_qr_path = os.path.join(tmp_qr_path, 'qr_meeting.png')
-        qrcode.make(session.meeting_link).save(meeting_qr_path)
-    else:
-        meeting_qr_path = None
-
-    paths = []
-    for idx, i in enumerate(img):
-        path_i = os.path.join(tmp_qr_path, 'qr_{}.png'.format(idx))
-        i.save(path_i)
-        paths.append(path_i)
-    zipped = [{'path': path, 'token': token}
-              for path, token in zip(paths, tokens)]
-    context = {
-        'session': session,
-        'tokens': zipped,
-        'meeting_link_qr': meeting_qr_path
-    }
-
-    template_name = 'vote/tex/invitation.tex'
-    pdf = generate_pdf(template_name, context, tmp_qr_path)
-    response = HttpResponse(content_type='application/pdf')
-    response['Content-Disposition'] = 'attachment; filename="tokenlist.pdf"'
-    response.write(bytes(pdf))
-    return response
-
-
-def generate_pdf(template_name: str, context: Dict, tex_path: str):
-    template = get_template(template_name).render(context).encode('utf8')
-    with open("/tmp/template.tex", "wb") as f:
-        f.write(template)
-    pdf = PdfLatexBuilder(pdflatex='pdflatex').build_pdf(
-        template, texinputs=[tex_path, ''])
-    return pdf
+    TokenSheet.start(session)
+    messages.add_message(request, messages.INFO,
+                         'The token sheet is being generated, it can be downloaded once it is ready.')
+    return redirect('management:session', pk=session.pk)
 
 
 @management_login_required
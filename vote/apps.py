@@ -1,5 +1,15 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class VoteConfig(AppConfig):
     name = 'vote'
+
+    def ready(self):
+        # pylint: disable=import-outside-toplevel
+        from vote import checks  # pylint: disable=unused-import
+
+        if settings.EXPORT_PROMETHEUS_METRICS:
+            from wahlfang import metrics
+            metrics.register_collector()
+            metrics.count_dropped_messages()
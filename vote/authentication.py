@@ -2,6 +2,7 @@ from django.contrib.auth.backends import BaseBackend
 from django.contrib.auth.decorators import user_passes_test
 
 from vote.models import Voter
+from wahlfang import metrics
 
 
 def voter_login_required(function=None, redirect_field_name=None):
@@ -33,9 +34,12 @@ class AccessCodeBackend(BaseBackend):
         except Voter.DoesNotExist:
             # Run the default password hasher once to reduce the timing
             # difference between an existing and a nonexistent user (#20760).
-            Voter().set_password(password)
+            with metrics.LOGIN_HASH_SECONDS.time():
+                Voter().set_password(password)
         else:
-            if voter.check_password(password):
+            with metrics.LOGIN_HASH_SECONDS.time():
+                valid = voter.check_password(password)
+            if valid:
                 if not voter.logged_in:
                     voter.logged_in = True
                     voter.save()
@@ -45,4 +49,4 @@ class AccessCodeBackend(BaseBackend):
         return None
 
     def get_user(self, user_id):
-        return Voter.objects.filter(pk=user_id).first()
+        return Voter.get_cached(user_id)
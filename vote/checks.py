@@ -0,0 +1,29 @@
+from django.conf import settings
+from django.core.checks import Tags, Warning, register  # pylint: disable=redefined-builtin
+
+PROCESS_LOCAL_CHANNEL_LAYERS = {'channels.layers.InMemoryChannelLayer'}
+PROCESS_LOCAL_CACHES = {'django.core.cache.backends.locmem.LocMemCache', 'django.core.cache.backends.dummy.DummyCache'}
+
+
+@register(Tags.caches, deploy=True)
+def check_shared_backends(app_configs, **kwargs):
+    """
+    Websocket notifications are sent from every process (ASGI workers, background threads, the email workers) and
+    cached values are invalidated from every process, so production deployments need backends shared between them.
+    """
+    errors = []
+    if settings.CHANNEL_LAYERS['default']['BACKEND'] in PROCESS_LOCAL_CHANNEL_LAYERS:
+        errors.append(Warning(
+            'The channel layer only delivers websocket notifications to sockets of the same process.',
+            hint='Use channels_redis.core.RedisChannelLayer, it is required for more than one ASGI process and for '
+                 'the notifications of the run_workers command. See docs/deploying.md.',
+            id='vote.W001',
+        ))
+    if settings.CACHES['default']['BACKEND'] in PROCESS_LOCAL_CACHES:
+        errors.append(Warning(
+            'The cache is not shared between processes, ASGI processes may show outdated elections and vote counts '
+            'and every process applies its own rate limits.',
+            hint='Use a shared cache like redis (django-redis) or memcached. See docs/deploying.md.',
+            id='vote.W002',
+        ))
+    return errors
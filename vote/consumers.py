@@ -1,30 +1,159 @@
+import asyncio
 import json
+import time
+from typing import Dict, Iterable, Optional, Tuple
 
+from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from django.conf import settings
 
-from vote.models import Session
+from vote.models import Application, OpenVote, Session
+from vote.notifications import connected_voters_group, notify_connected_voters, use_loop, voter_group
+from wahlfang import metrics
 
 
-class VoteConsumer(AsyncWebsocketConsumer):
+_publisher: Optional[asyncio.Task] = None
 
-    async def connect(self):
-        self.group = await database_sync_to_async(self.get_session_key)()  # pylint: disable=W0201
-        await self.channel_layer.group_add(self.group, self.channel_name)
+
+async def _publish_connections():
+    while True:
+        await asyncio.sleep(settings.WEBSOCKET_CONNECTIONS_TIMEOUT / 3)
+        await sync_to_async(metrics.publish_connections)()
+
+
+def _keep_connections_published():
+    """
+    Refresh the connection counts of this process before they expire, see wahlfang.metrics.publish_connections().
+    """
+    global _publisher  # pylint: disable=global-statement
+    if _publisher is None or _publisher.done():
+        _publisher = asyncio.ensure_future(_publish_connections())
+
+
+class ConsumerMetricsMixin:
+    """
+    Joins the channel groups of a websocket consumer and records its metrics (see wahlfang.metrics):
+
+    - the live connections per group, published to the cache for all processes and in a gauge per process
+    - the group messages handled by the websocket per message type
+    - the time from sending a group message until the websocket sent it to the browser
+
+    Consumers call join() instead of accept() in connect().
+    """
+    consumer_name = 'websocket'
+    joined_groups = ()
+    counted_groups = ()
+
+    async def join(self, groups: Iterable[str], counted: Iterable[str] = ()):
+        """
+        Join the channel groups and accept the connection. The websocket is also counted in the `counted` groups,
+        which it doesn't join because no messages are sent to them.
+        """
+        # the in-memory channel layer has to be used from the loop of the websockets
+        use_loop(asyncio.get_running_loop())
+        self.joined_groups = list(groups)  # pylint: disable=W0201
+        self.counted_groups = self.joined_groups + list(counted)  # pylint: disable=W0201
+        for group in self.joined_groups:
+            await self.channel_layer.group_add(group, self.channel_name)
+        await sync_to_async(metrics.groups_connected)(self.counted_groups)
+        _keep_connections_published()
+        for group in self.joined_groups:
+            metrics.CONNECTED_WEBSOCKETS.labels(metrics.group_kind(group)).inc()
+        metrics.WEBSOCKET_CONNECTS.labels(self.consumer_name).inc()
         await self.accept()
 
     async def disconnect(self, code):
-        await self.channel_layer.group_discard(self.group, self.channel_name)
+        if not self.counted_groups:
+            # the connection was refused before joining
+            return
+        for group in self.joined_groups:
+            await self.channel_layer.group_discard(group, self.channel_name)
+            metrics.CONNECTED_WEBSOCKETS.labels(metrics.group_kind(group)).dec()
+        await sync_to_async(metrics.groups_disconnected)(self.counted_groups)
+        metrics.WEBSOCKET_DISCONNECTS.labels(self.consumer_name).inc()
+
+    async def dispatch(self, message):
+        await super().dispatch(message)
+        if not message['type'].startswith('websocket.'):
+            metrics.WEBSOCKET_MESSAGES.labels(self.consumer_name, message['type']).inc()
+            if 'sent' in message:
+                metrics.WEBSOCKET_SEND_SECONDS.labels(self.consumer_name).observe(time.time() - message['sent'])
+
+
+class VoteConsumer(ConsumerMetricsMixin, AsyncWebsocketConsumer):
+    consumer_name = 'vote'
+
+    async def connect(self):
+        session_id = await database_sync_to_async(self.get_session_id)()
+        if self.is_spectator:
+            await self.join(["Session-" + str(session_id)])
+        else:
+            self.session_id = session_id  # pylint: disable=W0201
+            # (can_vote, edit) of the voter per election, see voter_card()
+            self.voter_flags: Dict[int, Tuple[bool, bool]] = {}  # pylint: disable=W0201
+            # not counted, the published connection counts would get an entry per voter
+            await self.channel_layer.group_add(voter_group(self.voter_id), self.channel_name)
+            await self.join(["Session-" + str(session_id)], counted=[connected_voters_group(session_id)])
+            await sync_to_async(notify_connected_voters)(session_id)
+
+    async def disconnect(self, code):
+        await super().disconnect(code)
+        if self.counted_groups and not self.is_spectator:
+            await self.channel_layer.group_discard(voter_group(self.voter_id), self.channel_name)
+            await sync_to_async(notify_connected_voters)(self.session_id)
 
     async def send_reload(self, event):
         await self.send(text_data=json.dumps({
             'reload': event['id'],
         }))
 
-    def get_session_key(self):
+    async def send_election(self, event):
+        html = None
+        if event['cards'] is not None:
+            if self.is_spectator:
+                html = event['cards']['spectator']
+            else:
+                html = await self.voter_card(event['id'], event['cards']['voter'])
+
+        await self.send(text_data=json.dumps({
+            'election': {'id': event['id'], 'section': event['section'], 'html': html},
+        }))
+
+    async def forget_voter_flags(self, event):
+        self.voter_flags.pop(event['id'], None)
+
+    async def voter_card(self, election_id, cards: dict) -> str:
+        """
+        Pick the variant of the voter card that matches this voter, see vote.notifications.render_election_cards().
+
+        The flags of the voter are only queried if the variants differ in them and at most once per election, they
+        are forgotten when the voter votes or changes their application (see notify_voter_flags_changed()).
+        """
+        can_vote_differs = '10' in cards
+        edit_differs = '01' in cards
+        if not can_vote_differs and not edit_differs:
+            return cards['00']
+        if election_id not in self.voter_flags:
+            self.voter_flags[election_id] = await database_sync_to_async(self.get_voter_flags)(election_id)
+        can_vote, edit = self.voter_flags[election_id]
+        return cards[f'{int(can_vote and can_vote_differs)}{int(edit and edit_differs)}']
+
+    def get_voter_flags(self, election_id) -> Tuple[bool, bool]:
+        return (
+            OpenVote.objects.filter(election_id=election_id, voter_id=self.voter_id).exists(),
+            Application.objects.filter(election_id=election_id, voter_id=self.voter_id).exists(),
+        )
+
+    def get_session_id(self):
         if 'uuid' in self.scope['url_route']['kwargs']:
             uuid = self.scope['url_route']['kwargs']['uuid']
-            session = Session.objects.get(spectator_token=uuid)
+            session = Session.get_by_spectator_token(uuid)
+            if session is None:
+                raise Session.DoesNotExist
+            self.is_spectator = True  # pylint: disable=W0201
         else:
             session = self.scope['user'].session
-        return "Session-" + str(session.pk)
+            self.is_spectator = False  # pylint: disable=W0201
+            self.voter_id = self.scope['user'].pk  # pylint: disable=W0201
+        return session.pk
@@ -1,13 +1,11 @@
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
 from django import forms
 from django.contrib.auth import authenticate
-from django.db import transaction
 from django.utils.translation import gettext_lazy as _
 
 from management.forms import ApplicationUploadForm
-from vote.models import Application, Voter, OpenVote, VOTE_CHOICES, Vote, VOTE_ABSTENTION, VOTE_ACCEPT, \
-    VOTE_CHOICES_NO_ABSTENTION
+from vote.models import VOTE_CHOICES, Vote, VOTE_ABSTENTION, VOTE_ACCEPT, VOTE_CHOICES_NO_ABSTENTION
+from vote.notifications import notify_vote_counters
+from wahlfang import metrics
 
 
 class AccessCodeAuthenticationForm(forms.Form):
@@ -78,26 +76,25 @@ class VoteField(forms.ChoiceField):
 class VoteForm(forms.Form):
     def __init__(self, request, election, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.voter = Voter.objects.get(voter_id=request.user.voter_id)
+        self.voter = request.user
         self.election = election
         self.request = request
+        # fetch the applications once, the fields keep a reference to their application
+        applications = list(self.election.applications.all())
+        self.num_applications = len(applications)
         if self.election.max_votes_yes is not None:
             self.max_votes_yes = self.election.max_votes_yes
         else:
-            self.max_votes_yes = self.election.applications.all().count()
+            self.max_votes_yes = self.num_applications
 
         # dynamically construct form fields
-        for application in self.election.applications.all():
+        for application in applications:
             self.fields[f'{application.pk}'] = VoteField(application=application,
                                                          enable_abstention=self.election.enable_abstention)
 
-        self.num_applications = self.election.applications.all().count()
-
     def clean(self):
         super().clean()
-        if not OpenVote.objects.filter(election_id=self.election.pk, voter_id=self.voter.pk).exists():
-            raise forms.ValidationError('You are not allowed to vote')
-
+        # whether the voter is still allowed to vote is checked when the ballot is saved
         votes_yes = 0
 
         for _, vote in self.cleaned_data.items():
@@ -108,28 +105,26 @@ class VoteForm(forms.Form):
             raise forms.ValidationError(
                 f'Too many "yes" votes, only max. {self.max_votes_yes} allowed.')
 
+    @metrics.VOTE_SAVE_SECONDS.time()
     def save(self, commit=True):
+        """
+        Store the ballot. Returns None (and adds a form error) if the voter was not allowed to vote (anymore).
+        """
         votes = [
             Vote(
                 election=self.election,
-                candidate=Application.objects.get(pk=int(name)),
+                candidate=self.fields[name].application,
                 vote=value
             ) for name, value in self.cleaned_data.items()
         ]
 
-        # existence of can_vote object already checked in clean()
-        can_vote = OpenVote.objects.get(election_id=self.election.pk, voter_id=self.voter.pk)
-
         if commit:
-            with transaction.atomic():
-                Vote.objects.bulk_create(votes)
-                can_vote.delete()
+            counters = self.election.cast_ballot(self.voter.pk, votes)
+            if counters is None:
+                self.add_error(None, 'You are not allowed to vote')
+                return None
             # notify manager that new votes were cast
-            group = "Election-" + str(self.election.pk)
-            async_to_sync(get_channel_layer().group_send)(
-                group,
-                {'type': 'send_reload', 'id': '#votes'}
-            )
+            notify_vote_counters(self.election, counters)
 
         return votes
 
@@ -0,0 +1,48 @@
+from django.contrib.auth.hashers import BasePasswordHasher, mask_hash
+from django.utils.crypto import constant_time_compare, salted_hmac
+from django.utils.translation import gettext_noop as _
+
+
+class AccessCodeHasher(BasePasswordHasher):
+    """
+    Hasher for the machine generated voter access codes.
+
+    Access codes are 20 random Enc32 characters (100 bits), a slow or memory-hard hash doesn't make them any harder
+    to guess but costs a lot of CPU when hundreds of voters log in at the start of a session. They are hashed with
+    a salted HMAC-SHA256 keyed with SECRET_KEY instead, so a leaked database alone isn't enough to verify codes.
+    Rotating SECRET_KEY invalidates all access codes hashed with this hasher.
+
+    Don't use this hasher for passwords chosen by humans.
+    """
+    algorithm = 'access_code_hmac_sha256'
+
+    def encode(self, password, salt):
+        assert password is not None
+        assert salt and '$' not in salt
+        hash = salted_hmac(self.algorithm, salt + password, algorithm='sha256').hexdigest()
+        return f'{self.algorithm}${salt}${hash}'
+
+    def decode(self, encoded):
+        algorithm, salt, hash = encoded.split('$', 2)
+        assert algorithm == self.algorithm
+        return {
+            'algorithm': algorithm,
+            'hash': hash,
+            'salt': salt,
+        }
+
+    def verify(self, password, encoded):
+        decoded = self.decode(encoded)
+        encoded_2 = self.encode(password, decoded['salt'])
+        return constant_time_compare(encoded, encoded_2)
+
+    def safe_summary(self, encoded):
+        decoded = self.decode(encoded)
+        return {
+            _('algorithm'): decoded['algorithm'],
+            _('salt'): mask_hash(decoded['salt'], show=2),
+            _('hash'): mask_hash(decoded['hash']),
+        }
+
+    def harden_runtime(self, password, encoded):
+        pass
@@ -0,0 +1,187 @@
+import re
+import secrets
+from argparse import Namespace
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+from django.conf import settings
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.html import escape, strip_tags
+
+# Placeholder for the per-voter fields while the invariant part of a mail is rendered. The random part makes sure it
+# can't appear in the texts written by the managers.
+_PLACEHOLDER = 'wahlfang' + secrets.token_hex(8)
+_PLACEHOLDER_RE = re.compile(re.escape(_PLACEHOLDER) + r'\[(\w+)\]')
+
+
+def _placeholder(field: str) -> str:
+    return f'{_PLACEHOLDER}[{field}]'
+
+
+class CompiledMail:
+    """
+    Mail body that was rendered once with placeholders for the per-voter fields.
+
+    Rendering a mail for a voter only joins the invariant parts with the voter's values, which are transformed exactly
+    like the rendered template: escaped if the template autoescapes, stripped of tags for the plain text and with
+    line breaks for the html message.
+    """
+
+    def __init__(self, body_html: str, autoescape: bool):
+        self.autoescape = autoescape
+        # even entries are literal text, odd entries the names of the fields
+        self.text = _PLACEHOLDER_RE.split(strip_tags(body_html))
+        self.html = _PLACEHOLDER_RE.split(body_html.replace('\n', '<br/>'))
+
+    @staticmethod
+    def _join(parts: List[str], values: Dict[str, str]) -> str:
+        return ''.join(part if i % 2 == 0 else values[part] for i, part in enumerate(parts))
+
+    def render(self, values: Dict[str, str]) -> Tuple[str, str]:
+        """
+        Return the plain text and the html message for the given field values.
+        """
+        if self.autoescape:
+            values = {field: escape(value) for field, value in values.items()}
+        return (
+            self._join(self.text, {field: strip_tags(value) for field, value in values.items()}),
+            self._join(self.html, {field: value.replace('\n', '<br/>') for field, value in values.items()}),
+        )
+
+
+class InvitationRenderer:
+    """
+    Renders the invitation mails of a session.
+
+    Everything that is the same for all voters is rendered once, the invitation of a single voter only fills in the
+    name, email, access code and login url. Renderers are cached per session content, see for_session().
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.subject = f'Invitation for {session.title}'
+        self.base_url = f'https://{settings.URL}'
+        # access codes only contain characters that don't need to be quoted in urls
+        self.login_url = self.base_url + reverse('vote:link_login', kwargs={'access_code': _PLACEHOLDER})
+        self.mails = {}
+
+    @classmethod
+    def for_session(cls, session) -> 'InvitationRenderer':
+        return _invitation_renderer(
+            session.title, session.invite_text, session.start_date, session.meeting_link, settings.URL,
+            timezone.get_current_timezone_name())
+
+    def compile(self, has_name: bool) -> CompiledMail:
+        session = self.session
+        if session.invite_text:
+            if session.start_date:
+                # cast to correct time zone
+                current_tz = timezone.get_current_timezone()
+                st = current_tz.normalize(session.start_date)
+            context = {
+                'name': _placeholder('name'),
+                'title': session.title,
+                'access_code': _placeholder('access_code'),
+                'login_url': _placeholder('login_url'),
+                'start_date': st.strftime("%d.%m.%Y") if session.start_date else "",
+                'start_time': st.strftime("%H:%M") if session.start_date else "",
+                'start_date_en': st.strftime("%Y/%m/%d") if session.start_date else "",
+                'start_time_en': st.strftime("%I:%M %p") if session.start_date else "",
+                'base_url': self.base_url,
+                'meeting_link': session.meeting_link
+            }
+            return CompiledMail(session.invite_text.format(**context), autoescape=False)
+
+        context = {
+            'voter': Namespace(name=_placeholder('name') if has_name else None, email=_placeholder('email')),
+            'session': session,
+            'base_url': self.base_url,
+            'login_url': _placeholder('login_url'),
+            'access_code': _placeholder('access_code'),
+        }
+        return CompiledMail(render_to_string('vote/mails/invitation.j2', context=context), autoescape=True)
+
+    def render(self, voter, access_code: str) -> Tuple[str, str, str]:
+        """
+        Return the subject, plain text and html message of the invitation of a voter.
+        """
+        has_name = bool(voter.name)
+        if has_name not in self.mails:
+            self.mails[has_name] = self.compile(has_name)
+        message, html_message = self.mails[has_name].render({
+            'name': str(voter.name),
+            'email': str(voter.email),
+            'access_code': access_code,
+            'login_url': self.login_url.replace(_PLACEHOLDER, access_code),
+        })
+        return self.subject, message, html_message
+
+
+class ReminderRenderer:
+    """
+    Renders the mails that remind the voters of a started election, like InvitationRenderer.
+    """
+
+    def __init__(self, election):
+        self.election = election
+        self.subject = f'{election.title} is now open'
+        self.url = f'https://{settings.URL}' + reverse('vote:vote', kwargs={'election_id': election.pk})
+        self.mails = {}
+
+    @classmethod
+    def for_election(cls, election) -> 'ReminderRenderer':
+        return _reminder_renderer(
+            election.pk, election.title, election.remind_text, election.end_date, settings.URL,
+            timezone.get_current_timezone_name())
+
+    def compile(self, has_name: bool) -> CompiledMail:
+        election = self.election
+        if election.remind_text:
+            if election.end_date:
+                # cast to correct time zone
+                current_tz = timezone.get_current_timezone()
+                et = current_tz.normalize(election.end_date)
+            context = {
+                'name': _placeholder('name'),
+                'title': election.title,
+                'url': self.url,
+                'end_date': et.strftime("%d.%m.%y") if election.end_date else "",
+                'end_time': et.strftime("%H:%M") if election.end_date else "",
+                'end_date_en': et.strftime("%Y/%m/%d") if election.end_date else "",
+                'end_time_en': et.strftime("%I:%M %p") if election.end_date else "",
+            }
+            return CompiledMail(election.remind_text.format(**context), autoescape=False)
+
+        context = {
+            'voter': Namespace(name=_placeholder('name') if has_name else None, email=_placeholder('email')),
+            'election': election,
+            'url': self.url,
+        }
+        return CompiledMail(render_to_string('vote/mails/start.j2', context=context), autoescape=True)
+
+    def render(self, voter) -> Tuple[str, str, str]:
+        """
+        Return the subject, plain text and html message of the reminder of a voter.
+        """
+        has_name = bool(voter.name)
+        if has_name not in self.mails:
+            self.mails[has_name] = self.compile(has_name)
+        message, html_message = self.mails[has_name].render({
+            'name': str(voter.name),
+            'email': str(voter.email),
+        })
+        return self.subject, message, html_message
+
+
+# The renderers only depend on the arguments of these functions, a changed text or date results in a new renderer.
+@lru_cache(maxsize=128)
+def _invitation_renderer(title, invite_text, start_date, meeting_link, url, tz_name) -> InvitationRenderer:
+    return InvitationRenderer(Namespace(
+        title=title, invite_text=invite_text, start_date=start_date, meeting_link=meeting_link))
+
+
+@lru_cache(maxsize=128)
+def _reminder_renderer(pk, title, remind_text, end_date, url, tz_name) -> ReminderRenderer:
+    return ReminderRenderer(Namespace(pk=pk, title=title, remind_text=remind_text, end_date=end_date))
@@ -0,0 +1,99 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from vote.models import Application, Election, OpenVote, Session, Vote, Voter, TALLY_FIELDS, VOTE_CHOICES
+
+
+class Command(BaseCommand):
+    help = 'Seed a large session and report query plans and latency of the hot voter and vote lookups'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--voters', type=int, default=10000)
+        parser.add_argument('-e', '--elections', type=int, default=100)
+        parser.add_argument('-c', '--candidates', type=int, default=3)
+        parser.add_argument('--turnout', type=float, default=0.5, help='share of voters that voted in each election')
+        parser.add_argument('-r', '--repeat', type=int, default=200, help='number of times every query is run')
+        parser.add_argument('--keep', action='store_true', help='commit the generated data instead of rolling back')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.seed(options)
+            self.benchmark(options)
+            if not options['keep']:
+                transaction.set_rollback(True)
+
+    def seed(self, options):
+        start = time.perf_counter()
+        self.session = Session.objects.create(title=f'Benchmark {timezone.now():%Y-%m-%d %H:%M:%S}')
+        # bulk_create everything: the benchmark doesn't need passwords, tallies or websocket notifications
+        Voter.objects.bulk_create([
+            Voter(session=self.session, password='!', email=f'voter{i}@example.org')
+            for i in range(options['voters'])
+        ], batch_size=1000)
+        Election.objects.bulk_create([
+            Election(session=self.session, title=f'Election {i}', start_date=timezone.now())
+            for i in range(options['elections'])
+        ])
+        self.voter_ids = list(Voter.objects.filter(session=self.session).values_list('pk', flat=True))
+        self.election_ids = list(Election.objects.filter(session=self.session).values_list('pk', flat=True))
+        Application.objects.bulk_create([
+            Application(election_id=election_id, display_name=f'Candidate {i}')
+            for election_id in self.election_ids for i in range(options['candidates'])
+        ])
+        candidates = {}
+        for application in Application.objects.filter(election__session=self.session):
+            candidates.setdefault(application.election_id, []).append(application.pk)
+
+        voted = int(len(self.voter_ids) * options['turnout'])
+        for election_id in self.election_ids:
+            random.shuffle(self.voter_ids)
+            OpenVote.objects.bulk_create([
+                OpenVote(election_id=election_id, voter_id=voter_id) for voter_id in self.voter_ids[voted:]
+            ], batch_size=5000)
+            Vote.objects.bulk_create([
+                Vote(election_id=election_id, candidate_id=candidate_id, vote=random.choice(VOTE_CHOICES)[0])
+                for _ in range(voted) for candidate_id in candidates[election_id]
+            ], batch_size=5000)
+        self.stdout.write(
+            f'Seeded {len(self.voter_ids)} voters, {len(self.election_ids)} elections, '
+            f'{OpenVote.objects.filter(election__session=self.session).count()} open votes and '
+            f'{Vote.objects.filter(election__session=self.session).count()} votes '
+            f'in {time.perf_counter() - start:.1f}s'
+        )
+
+    def benchmark(self, options):
+        queries = {
+            'open vote of a voter (Voter.can_vote, Election.cast_ballot)': lambda voter_id, election_id:
+                OpenVote.objects.filter(voter_id=voter_id, election_id=election_id),
+            'open votes of a voter (index view)': lambda voter_id, election_id:
+                OpenVote.objects.filter(voter_id=voter_id).values_list('election_id', flat=True),
+            'votes per choice of the candidates (rebuild_tallies)': lambda voter_id, election_id:
+                Application.objects.filter(election_id=election_id).annotate(**{
+                    field: Count('votes', filter=Q(votes__vote=choice)) for choice, field in TALLY_FIELDS.items()
+                }),
+            'votes of an election (number_votes_cast)': lambda voter_id, election_id:
+                Vote.objects.filter(election_id=election_id).values('election_id').annotate(count=Count('pk')),
+            'voter by email (AddVotersForm)': lambda voter_id, election_id:
+                Voter.objects.filter(session=self.session, email=f'voter{voter_id % len(self.voter_ids)}@example.org'),
+        }
+
+        for name, query in queries.items():
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            self.stdout.write(query(self.voter_ids[0], self.election_ids[0]).explain())
+            timings = []
+            for _ in range(options['repeat']):
+                queryset = query(random.choice(self.voter_ids), random.choice(self.election_ids))
+                start = time.perf_counter()
+                list(queryset)
+                timings.append(time.perf_counter() - start)
+            timings.sort()
+            self.stdout.write(
+                f'{connection.vendor}: median {statistics.median(timings) * 1000:.2f}ms, '
+                f'p95 {timings[int(len(timings) * 0.95)] * 1000:.2f}ms, max {timings[-1] * 1000:.2f}ms'
+            )
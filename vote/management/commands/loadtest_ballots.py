@@ -0,0 +1,121 @@
+import random
+import statistics
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from vote.models import Application, Election, OpenVote, Session, Tally, Vote, Voter, TALLY_FIELDS, VOTE_CHOICES
+
+
+class Command(BaseCommand):
+    help = 'Submit ballots from many concurrent threads against the configured database and verify the result'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--voters', type=int, default=500)
+        parser.add_argument('-c', '--candidates', type=int, default=5)
+        parser.add_argument('-t', '--threads', type=int, default=50)
+        parser.add_argument('-d', '--duplicates', type=int, default=2,
+                            help='number of times every voter submits their ballot')
+        parser.add_argument('--keep', action='store_true', help='do not delete the generated session afterwards')
+
+    def handle(self, *args, **options):
+        session = Session.objects.create(title=f'Load test {timezone.now():%Y-%m-%d %H:%M:%S}')
+        try:
+            self.run(session, options)
+        finally:
+            if not options['keep']:
+                session.delete()
+
+    def run(self, session, options):
+        election = Election.objects.create(session=session, title='Load test', start_date=timezone.now())
+        candidates = [
+            Application.objects.create(election=election, display_name=f'candidate {i}')
+            for i in range(options['candidates'])
+        ]
+        # voters don't need a usable password for submitting ballots, skip the expensive hashing
+        Voter.objects.bulk_create([Voter(session=session, password='!') for _ in range(options['voters'])])
+        voter_ids = list(Voter.objects.filter(session=session).values_list('pk', flat=True))
+        OpenVote.objects.bulk_create([OpenVote(election=election, voter_id=voter_id) for voter_id in voter_ids])
+
+        submissions = voter_ids * options['duplicates']
+        random.shuffle(submissions)
+        lock = threading.Lock()
+        results = {'stored': [], 'rejected': 0, 'errors': [], 'latencies': []}
+
+        def submit(voter_ids):
+            try:
+                for voter_id in voter_ids:
+                    votes = [
+                        Vote(election=election, candidate=candidate, vote=random.choice(VOTE_CHOICES)[0])
+                        for candidate in candidates
+                    ]
+                    start = time.perf_counter()
+                    try:
+                        stored = election.cast_ballot(voter_id, votes)
+                    except Exception as e:  # pylint: disable=W0703
+                        with lock:
+                            results['errors'].append(str(e))
+                        continue
+                    with lock:
+                        results['latencies'].append(time.perf_counter() - start)
+                        if stored:
+                            results['stored'].append(voter_id)
+                        else:
+                            results['rejected'] += 1
+            finally:
+                connection.close()
+
+        threads = [
+            threading.Thread(target=submit, args=(submissions[i::options['threads']],))
+            for i in range(options['threads'])
+        ]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.perf_counter() - start
+        connections.close_all()
+
+        latencies = sorted(results['latencies'])
+        self.stdout.write(
+            f'{connection.vendor}: {len(submissions)} submissions from {options["threads"]} threads in {duration:.2f}s '
+            f'({len(submissions) / duration:.1f}/s), {len(results["stored"])} stored, {results["rejected"]} rejected, '
+            f'{len(results["errors"])} failed'
+        )
+        if latencies:
+            self.stdout.write(
+                f'latency: median {statistics.median(latencies) * 1000:.1f}ms, '
+                f'p95 {latencies[int(len(latencies) * 0.95)] * 1000:.1f}ms, max {latencies[-1] * 1000:.1f}ms'
+            )
+        for error in sorted(set(results['errors'])):
+            self.stdout.write(self.style.WARNING(f'error: {error}'))
+
+        self.verify(election, candidates, voter_ids, results['stored'])
+
+    def verify(self, election, candidates, voter_ids, stored):
+        problems = []
+        if len(stored) != len(set(stored)):
+            problems.append('a voter submitted more than one ballot')
+        if election.votes.count() != len(stored) * len(candidates):
+            problems.append(f'{election.votes.count()} votes stored, expected {len(stored) * len(candidates)}')
+        open_votes = election.open_votes.count()
+        if open_votes != len(voter_ids) - len(stored):
+            problems.append(f'{open_votes} open votes left, expected {len(voter_ids) - len(stored)}')
+
+        counted = Application.objects.filter(election=election).annotate(**{
+            field: Count('votes', filter=Q(votes__vote=choice)) for choice, field in TALLY_FIELDS.items()
+        })
+        tallies = {tally.application_id: tally for tally in Tally.objects.filter(application__election=election)}
+        for application in counted:
+            tally = tallies[application.pk]
+            if any(getattr(tally, field) != getattr(application, field) for field in TALLY_FIELDS.values()):
+                problems.append(f'tally of {application.display_name} does not match the cast votes')
+
+        if problems:
+            raise CommandError('\n'.join(problems))
+        self.stdout.write(self.style.SUCCESS('Every voter voted at most once and all tallies match the cast votes'))
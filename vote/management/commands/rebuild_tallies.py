@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, Q
+
+from vote.models import Application, Election, Tally, TALLY_FIELDS
+
+
+class Command(BaseCommand):
+    help = 'Verify the vote tallies against the cast votes and rebuild them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-e', '--election-id', type=int, help='only check the applications of this election')
+        parser.add_argument('--verify', action='store_true',
+                            help='only report tallies that do not match the votes, do not change anything')
+
+    def handle(self, *args, **options):
+        applications = Application.objects.all()
+        if options['election_id']:
+            applications = applications.filter(election_id=options['election_id'])
+
+        with transaction.atomic():
+            # lock the tallies first: ballots submitted meanwhile wait for the rebuild and are added on top of it
+            tallies = {
+                tally.application_id: tally
+                for tally in Tally.objects.select_for_update().filter(application__in=applications)
+            }
+            counted = applications.annotate(**{
+                field: Count('votes', filter=Q(votes__vote=choice)) for choice, field in TALLY_FIELDS.items()
+            })
+
+            mismatches = []
+            missing = []
+            changed_elections = set()
+            for application in counted:
+                tally = tallies.get(application.pk)
+                if tally is None:
+                    missing.append(Tally(application=application, **{
+                        field: getattr(application, field) for field in TALLY_FIELDS.values()
+                    }))
+                    self.stdout.write(self.style.WARNING(f'{application}: no tally'))
+                    changed_elections.add(application.election_id)
+                    continue
+
+                for field in TALLY_FIELDS.values():
+                    if getattr(tally, field) != getattr(application, field):
+                        self.stdout.write(self.style.WARNING(
+                            f'{application}: {field} is {getattr(tally, field)}, '
+                            f'counted {getattr(application, field)} votes'))
+                        setattr(tally, field, getattr(application, field))
+                        if tally not in mismatches:
+                            mismatches.append(tally)
+                            changed_elections.add(application.election_id)
+
+            if options['verify']:
+                if mismatches or missing:
+                    raise CommandError(f'{len(mismatches) + len(missing)} tallies do not match the cast votes')
+                self.stdout.write(self.style.SUCCESS(f'All {len(tallies)} tallies match the cast votes'))
+                return
+
+            Tally.objects.bulk_create(missing)
+            Tally.objects.bulk_update(mismatches, list(TALLY_FIELDS.values()))
+
+        for election_id in changed_elections:
+            Election.invalidate_cards(election_id)
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt {len(mismatches) + len(missing)} of {len(tallies) + len(missing)} tallies'))
@@ -0,0 +1,41 @@
+# Generated by Django 3.2.25 on 2026-10-18 02:03
+
+from django.db import migrations, models
+from django.db.models import Count, Q
+import django.db.models.deletion
+
+
+def count_votes(apps, schema_editor):
+    application = apps.get_model('vote', 'application')
+    tally = apps.get_model('vote', 'tally')
+    applications = application.objects.annotate(
+        votes_accept=Count('votes', filter=Q(votes__vote='accept')),
+        votes_reject=Count('votes', filter=Q(votes__vote='reject')),
+        votes_abstention=Count('votes', filter=Q(votes__vote='abstention')),
+    )
+    tally.objects.bulk_create([
+        tally(application_id=row.pk, votes_accept=row.votes_accept, votes_reject=row.votes_reject,
+              votes_abstention=row.votes_abstention)
+        for row in applications
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vote', '0031_voter_qr'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Tally',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('votes_accept', models.PositiveIntegerField(default=0)),
+                ('votes_reject', models.PositiveIntegerField(default=0)),
+                ('votes_abstention', models.PositiveIntegerField(default=0)),
+                ('application', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='tally', to='vote.application')),
+            ],
+        ),
+        migrations.RunPython(count_votes, reverse_code=migrations.RunPython.noop),
+    ]
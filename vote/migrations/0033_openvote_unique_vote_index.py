@@ -0,0 +1,32 @@
+# Generated by Django 3.2.25 on 2026-10-18 02:08
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def remove_duplicate_open_votes(apps, schema_editor):
+    open_vote = apps.get_model('vote', 'openvote')
+    duplicates = open_vote.objects.values('voter_id', 'election_id').annotate(
+        count=Count('id'), keep=Min('id')).filter(count__gt=1)
+    for row in duplicates:
+        open_vote.objects.filter(voter_id=row['voter_id'], election_id=row['election_id']).exclude(
+            id=row['keep']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vote', '0032_tally'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_open_votes, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='openvote',
+            unique_together={('voter', 'election')},
+        ),
+        migrations.AddIndex(
+            model_name='vote',
+            index=models.Index(fields=['candidate', 'vote'], name='vote_candidate_vote_idx'),
+        ),
+    ]
@@ -6,26 +6,27 @@ from argparse import Namespace
 from datetime import datetime
 from functools import partial
 from io import BytesIO
-from typing import Tuple, Optional
+from typing import Iterable, List, Optional, Set, Tuple
 
 import PIL
 from PIL import Image
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
 from django.conf import settings
 from django.contrib.auth import password_validation
 from django.contrib.auth.hashers import (
     check_password, is_password_usable, make_password,
 )
+from django.core.cache import cache
 from django.core.files.uploadedfile import InMemoryUploadedFile
 from django.core.mail import send_mail
-from django.db import models
-from django.db.models import Count, Q, CASCADE
-from django.template.loader import render_to_string
-from django.urls import reverse
+from django.db import DatabaseError, connection, models, transaction
+from django.db.models import CASCADE, Case, F, Value, When
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 from django.utils.crypto import get_random_string
-from django.utils.html import strip_tags
+
+from vote.hashers import AccessCodeHasher
+from vote.mails import InvitationRenderer, ReminderRenderer
+from wahlfang import metrics
 
 VOTE_ACCEPT = 'accept'
 VOTE_ABSTENTION = 'abstention'
@@ -41,6 +42,20 @@ VOTE_CHOICES_NO_ABSTENTION = [
     (VOTE_REJECT, 'No'),
 ]
 
+# Tally field counting the votes of each choice
+TALLY_FIELDS = {
+    VOTE_ACCEPT: 'votes_accept',
+    VOTE_REJECT: 'votes_reject',
+    VOTE_ABSTENTION: 'votes_abstention',
+}
+
+# cached vote counters are recomputed from the database at least this often (in seconds)
+VOTE_COUNTERS_TIMEOUT = 5 * 60
+VOTE_COUNTERS = ('voters', 'cast', 'open')
+
+# number of rows inserted per query when creating voters and open votes in bulk
+BULK_CREATE_BATCH_SIZE = 500
+
 
 class Enc32:
     alphabet = "0123456789abcdefghjknpqrstuvwxyz"
@@ -75,6 +90,30 @@ class Enc32:
         return i
 
 
+def session_elections_cache_key(session_id) -> str:
+    return f'session-{session_id}-elections'
+
+
+def election_card_version_key(election_id) -> str:
+    return f'election-{election_id}-card-version'
+
+
+def session_cache_key(session_id) -> str:
+    return f'session-{session_id}'
+
+
+def spectator_token_cache_key(token) -> str:
+    return f'spectator-{token}'
+
+
+def spectator_snapshot_cache_key(session_id) -> str:
+    return f'session-{session_id}-spectator'
+
+
+def voter_cache_key(voter_id) -> str:
+    return f'voter-{voter_id}'
+
+
 class Session(models.Model):
     title = models.CharField(max_length=256)
     meeting_link = models.CharField(max_length=512, blank=True, null=True)
@@ -90,6 +129,46 @@ class Session(models.Model):
         self.save()
         return myid
 
+    @classmethod
+    def get_by_spectator_token(cls, token) -> Optional['Session']:
+        """
+        Return the session of a spectator token for the spectator page and websocket.
+
+        The token is mapped to the session in the cache and the session comes from the same cache as in
+        Voter.get_cached(), so reloads and reconnects of the spectators don't query the database.
+        """
+        session_id = cache.get(spectator_token_cache_key(token))
+        session = cache.get(session_cache_key(session_id)) if session_id is not None else None
+        if session is None or session.spectator_token != token:
+            # the token may have been replaced since it was cached
+            session = cls.objects.filter(spectator_token=token).first()
+            if session is None:
+                return None
+            cache.set_many({spectator_token_cache_key(token): session.pk, session_cache_key(session.pk): session},
+                           timeout=settings.USER_CACHE_TIMEOUT)
+        return session
+
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        super().save(force_insert, force_update, using, update_fields)
+        # primary keys may be reused (e.g. by SQLite), don't let a new session see the elections of a deleted one
+        cache.delete_many([session_elections_cache_key(self.pk), session_cache_key(self.pk),
+                           spectator_snapshot_cache_key(self.pk)])
+
+    def delete(self, using=None, keep_parents=False):
+        pk = self.pk
+        result = super().delete(using, keep_parents)
+        # the cached voters of the session are only used together with the cached session
+        cache.delete_many([session_cache_key(pk), spectator_snapshot_cache_key(pk)])
+        return result
+
+    def participant_emails(self) -> Set[str]:
+        return set(self.participants.exclude(email=None).values_list('email', flat=True))
+
+    def reset_vote_counters(self):
+        # the number of voters and open votes changes for all elections of the session
+        for election in self.elections.only('pk'):
+            election.reset_vote_counters()
+
 
 class Election(models.Model):
     title = models.CharField(max_length=512)
@@ -138,17 +217,21 @@ class Election(models.Model):
     @property
     def election_summary(self):
         if not self.closed:
-            return self.objects.none()
-
-        votes_accept = Count('votes', filter=Q(votes__vote=VOTE_ACCEPT))
-        votes_reject = Count('votes', filter=Q(votes__vote=VOTE_REJECT))
-        votes_abstention = Count('votes', filter=Q(votes__vote=VOTE_ABSTENTION))
-
-        applications = Application.objects.filter(election_id=self.pk).annotate(
-            votes_accept=votes_accept,
-            votes_reject=votes_reject,
-            votes_abstention=votes_abstention
-        ).order_by('-votes_accept')
+            return Application.objects.none()
+
+        if 'applications' in getattr(self, '_prefetched_objects_cache', {}):
+            # applications (and their tallies) were already fetched together with the election
+            applications = list(self.applications.all())
+            for application in applications:
+                tally = getattr(application, 'tally', None)
+                for field in TALLY_FIELDS.values():
+                    setattr(application, field, getattr(tally, field, 0))
+            return sorted(applications, key=lambda application: application.votes_accept, reverse=True)
+
+        # the votes are counted into the tally table when the ballot is submitted
+        applications = Application.objects.filter(election_id=self.pk).annotate(**{
+            field: Coalesce(F(f'tally__{field}'), 0) for field in TALLY_FIELDS.values()
+        }).order_by('-votes_accept')
 
         return applications
 
@@ -163,14 +246,116 @@ class Election(models.Model):
             return 0
         return int(self.votes.count() / self.applications.all().count())
 
+    def cast_ballot(self, voter_id, votes: List['Vote']) -> Optional[dict]:
+        """
+        Store the votes of a voter's ballot and return the updated vote counters. Returns None if the voter is not
+        allowed to vote (anymore).
+
+        The voter's OpenVote is claimed with a conditional DELETE, its row count decides whether the ballot is
+        stored. Concurrent submissions of the same voter serialize on that single row, the loser sees a row count
+        of zero and stores nothing. The shared tally rows are updated last to hold their locks as short as possible.
+        """
+        try:
+            with transaction.atomic():
+                claimed, _ = OpenVote.objects.filter(election_id=self.pk, voter_id=voter_id).delete()
+                if not claimed:
+                    return None
+                Vote.objects.bulk_create(votes)
+                Tally.count_ballot(votes)
+                # while the tallies are locked, so concurrent ballots update the counters in the order they commit
+                counters = self.count_ballot()
+                # a ballot committed right after the end of the election changes its result
+                transaction.on_commit(lambda: self.invalidate_cards(self.pk))
+                from vote.notifications import notify_voter_flags_changed  # pylint: disable=import-outside-toplevel
+                transaction.on_commit(lambda: notify_voter_flags_changed(voter_id, self.pk))
+        except DatabaseError:
+            # the counters may already contain the ballot that was rolled back
+            self.reset_vote_counters()
+            raise
+        return counters
+
+    def _vote_counter_keys(self):
+        return {name: f'election-{self.pk}-{name}' for name in VOTE_COUNTERS}
+
+    def vote_counters(self) -> dict:
+        """
+        Return the number of voters, cast votes and open votes of this election.
+
+        The counters are kept in the cache and updated incrementally on every cast ballot,
+        so watching an election does not cost three COUNT queries per ballot.
+        """
+        keys = self._vote_counter_keys()
+        cached = cache.get_many(keys.values())
+        if len(cached) == len(keys):
+            return {name: cached[key] for name, key in keys.items()}
+
+        counters = self._count_votes()
+        # a ballot may have been counted since the database was queried, the counters it stored are newer
+        for name, value in counters.items():
+            cache.add(keys[name], value, timeout=VOTE_COUNTERS_TIMEOUT)
+        return counters
+
+    def _count_votes(self) -> dict:
+        return {
+            'voters': self.number_voters(),
+            'cast': self.number_votes_cast(),
+            'open': self.number_votes_open(),
+        }
+
+    def count_ballot(self) -> dict:
+        """
+        Account for a newly cast ballot in the vote counters and return the updated counters. Has to run in the
+        transaction that stores the ballot, after the tallies were updated.
+        """
+        keys = self._vote_counter_keys()
+        try:
+            cache.incr(keys['cast'])
+            cache.decr(keys['open'])
+        except ValueError:
+            # (some) counters are not cached, start over from the database. The transaction sees all ballots that
+            # were committed before and holds back the ones that come after it, so the counters are exact.
+            counters = self._count_votes()
+            cache.set_many({keys[name]: value for name, value in counters.items()}, timeout=VOTE_COUNTERS_TIMEOUT)
+            return counters
+        return self.vote_counters()
+
+    def reset_vote_counters(self):
+        cache.delete_many(self._vote_counter_keys().values())
+
+    @property
+    def card_version(self) -> str:
+        """
+        Version of the rendered election cards, part of the key of the cached card fragments.
+
+        It changes whenever the election, its applications or its votes change and whenever the election starts or
+        ends, which changes the cards without saving the election.
+        """
+        version = cache.get_or_set(election_card_version_key(self.pk), lambda: uuid.uuid4().hex,
+                                   timeout=settings.ELECTION_CARD_CACHE_TIMEOUT)
+        return f'{version}-{int(self.started)}{int(self.is_open)}{int(self.closed)}'
+
+    @staticmethod
+    def invalidate_cards(election_id):
+        cache.delete(election_card_version_key(election_id))
+
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        adding = self._state.adding
         super().save(force_insert, force_update, using, update_fields)
-        # notify users to reload their page
-        group = "Session-" + str(self.session.pk)
-        async_to_sync(get_channel_layer().group_send)(
-            group,
-            {'type': 'send_reload', 'id': '#electionCard'}
-        )
+        if adding:
+            self.reset_vote_counters()
+        self.invalidate_cards(self.pk)
+        cache.delete(session_elections_cache_key(self.session_id))
+        # push the updated election card to the pages of the session once everything that is saved along with the
+        # election is committed, e.g. the open votes of a new election
+        from vote.notifications import notify_election_changed  # pylint: disable=import-outside-toplevel
+        transaction.on_commit(lambda: notify_election_changed(self))
+
+    def delete(self, using=None, keep_parents=False):
+        from vote.notifications import notify_election_deleted  # pylint: disable=import-outside-toplevel
+        notify_election_deleted(self)
+        result = super().delete(using, keep_parents)
+        cache.delete(session_elections_cache_key(self.session_id))
+        return result
 
     def __str__(self):
         return self.title
@@ -208,20 +393,45 @@ class Voter(models.Model):
             return
 
         super().save(force_insert, force_update, using, update_fields)
+        cache.delete(voter_cache_key(self.pk))
         if self._password is not None:
             password_validation.password_changed(self._password, self)
             self._password = None
         # notify manager to reload their page, if the user logged in
-        group = "Login-Session-" + str(self.session.pk)
-        async_to_sync(get_channel_layer().group_send)(
-            group,
-            {'type': 'send_reload', 'id': '#voterCard'}
-        )
+        from vote.notifications import notify_reload  # pylint: disable=import-outside-toplevel
+        notify_reload("Login-Session-" + str(self.session_id), '#voterCard')
+
+    def delete(self, using=None, keep_parents=False):
+        pk = self.pk
+        result = super().delete(using, keep_parents)
+        cache.delete(voter_cache_key(pk))
+        self.session.reset_vote_counters()
+        return result
+
+    @classmethod
+    def get_cached(cls, pk) -> Optional['Voter']:
+        """
+        Return the voter together with its session for authenticating a request or websocket.
+
+        Voter and session are cached separately for USER_CACHE_TIMEOUT seconds and invalidated when they are saved or
+        deleted, so reloads and reconnects of all voters of a session don't query the database.
+        """
+        voter = cache.get(voter_cache_key(pk))
+        session = cache.get(session_cache_key(voter.session_id)) if voter is not None else None
+        if session is None:
+            voter = cls.objects.select_related('session').filter(pk=pk).first()
+            if voter is None:
+                return None
+            cache.set_many({voter_cache_key(pk): voter, session_cache_key(voter.session_id): voter.session},
+                           timeout=settings.USER_CACHE_TIMEOUT)
+        else:
+            voter.session = session
+        return voter
 
     def set_password(self, raw_password=None):
         if not raw_password:
             raw_password = get_random_string(length=20, allowed_chars=Enc32.alphabet)
-        self.password = make_password(raw_password)
+        self.password = make_password(raw_password, hasher=AccessCodeHasher.algorithm)
         self._password = raw_password
         return raw_password
 
@@ -237,7 +447,8 @@ class Voter(models.Model):
             self._password = None
             self.save(update_fields=['password'])
 
-        return check_password(raw_password, self.password, setter)
+        # access codes hashed with one of the slow password hashers are rehashed on their next login
+        return check_password(raw_password, self.password, setter, preferred=AccessCodeHasher.algorithm)
 
     def set_unusable_password(self):
         # Set a value that will never be a valid hash
@@ -270,8 +481,13 @@ class Voter(models.Model):
         """Send an email to this user."""
         if self.email is not None:
             try:
-                send_mail(subject, message, from_email, [self.email], **kwargs)
+                if kwargs.get('connection') is not None:
+                    # (re)open a shared connection, this is a no-op if it is open already
+                    kwargs['connection'].open()
+                with metrics.MAIL_SEND_SECONDS.time():
+                    send_mail(subject, message, from_email, [self.email], **kwargs)
             except Exception as e:  # pylint: disable=W0703
+                metrics.MAIL_FAILURES.inc()
                 return self, str(e)
         # None means everything is ok
         return None, None
@@ -327,81 +543,31 @@ class Voter(models.Model):
 
         Voter.send_invitation(test_voter, "mock-up-access-token", from_email)
 
-    def send_invitation(self, access_code: str, from_email: str) -> Tuple[Optional['Voter'], Optional[str]]:
+    def send_invitation(self, access_code: str, from_email: str,
+                        connection=None) -> Tuple[Optional['Voter'], Optional[str]]:
         if not self.email:
             return None, None
-        subject = f'Invitation for {self.session.title}'
-        if self.session.invite_text:
-            if self.session.start_date:
-                # cast to correct time zone
-                current_tz = timezone.get_current_timezone()
-                st = current_tz.normalize(self.session.start_date)
-            context = {
-                'name': self.name,
-                'title': self.session.title,
-                'access_code': access_code,
-                'login_url': f'https://{settings.URL}' + reverse('vote:link_login',
-                                                                 kwargs={'access_code': access_code}),
-                'start_date': st.strftime("%d.%m.%Y") if self.session.start_date else "",
-                'start_time': st.strftime("%H:%M") if self.session.start_date else "",
-                'start_date_en': st.strftime("%Y/%m/%d") if self.session.start_date else "",
-                'start_time_en': st.strftime("%I:%M %p") if self.session.start_date else "",
-                'base_url': f'https://{settings.URL}',
-                'meeting_link': self.session.meeting_link
-            }
-            body_html = self.session.invite_text.format(**context)
-        else:
-            context = {
-                'voter': self,
-                'session': self.session,
-                'base_url': f'https://{settings.URL}',
-                'login_url': f'https://{settings.URL}' + reverse('vote:link_login',
-                                                                 kwargs={'access_code': access_code}),
-                'access_code': access_code,
-            }
-            body_html = render_to_string('vote/mails/invitation.j2', context=context)
-
+        subject, message, html_message = InvitationRenderer.for_session(self.session).render(self, access_code)
         return self.email_user(
             subject=subject,
-            message=strip_tags(body_html),
+            message=message,
             from_email=from_email,
-            html_message=body_html.replace('\n', '<br/>'),
-            fail_silently=False
+            html_message=html_message,
+            fail_silently=False,
+            connection=connection,
         )
 
-    def send_reminder(self, from_email: str, election):
+    def send_reminder(self, from_email: str, election, connection=None) -> Tuple[Optional['Voter'], Optional[str]]:
         if not self.email:
-            return
-        subject = f'{election.title} is now open'
-        if election.remind_text:
-            if election.end_date:
-                # cast to correct time zone
-                current_tz = timezone.get_current_timezone()
-                et = current_tz.normalize(election.end_date)
-            context = {
-                'name': self.name,
-                'title': election.title,
-                'url': f'https://{settings.URL}' + reverse('vote:vote', kwargs={'election_id': election.pk}),
-                'end_date': et.strftime("%d.%m.%y") if election.end_date else "",
-                'end_time': et.strftime("%H:%M") if election.end_date else "",
-                'end_date_en': et.strftime("%Y/%m/%d") if election.end_date else "",
-                'end_time_en': et.strftime("%I:%M %p") if election.end_date else "",
-            }
-            body_html = election.remind_text.format(**context)
-        else:
-            context = {
-                'voter': self,
-                'election': election,
-                'url': f'https://{settings.URL}' + reverse('vote:vote', kwargs={'election_id': election.pk}),
-            }
-            body_html = render_to_string('vote/mails/start.j2', context=context)
-
-        self.email_user(
+            return None, None
+        subject, message, html_message = ReminderRenderer.for_election(election).render(self)
+        return self.email_user(
             subject=subject,
-            message=strip_tags(body_html),
+            message=message,
             from_email=from_email,
-            html_message=body_html.replace('\n', '<br/>'),
-            fail_silently=True
+            html_message=html_message,
+            fail_silently=False,
+            connection=connection,
         )
 
     @staticmethod
@@ -442,9 +608,63 @@ class Voter(models.Model):
         open_votes = [OpenVote(election=election, voter=voter) for election in session.elections.all()
                       if not election.closed]
         OpenVote.objects.bulk_create(open_votes)
+        session.reset_vote_counters()
 
         return voter, cls.get_access_code(voter.voter_id, password)
 
+    @classmethod
+    def bulk_from_data(cls, session, rows: Iterable[dict], access_codes=True) -> List[Tuple['Voter', Optional[str]]]:
+        """
+        Create many voters of a session at once, rows are dicts with the optional keys email, name and qr.
+
+        Unlike from_data the voters and their open votes are inserted with a few bulk_create calls inside one
+        transaction and the manager pages are only notified once. Without access_codes the voters get an unusable
+        password instead of a hashed access code, e.g. because their invitation issues one (see MailJob.send()).
+        """
+        voters = []
+        passwords = []
+        for row in rows:
+            voter = Voter(session=session, email=row.get('email'), name=row.get('name'), qr=row.get('qr', False))
+            if access_codes:
+                passwords.append(voter.set_password())
+            else:
+                voter.set_unusable_password()
+                passwords.append(None)
+            voters.append(voter)
+        if not voters:
+            return []
+
+        with transaction.atomic():
+            Voter.objects.bulk_create(voters, batch_size=BULK_CREATE_BATCH_SIZE)
+            if not connection.features.can_return_rows_from_bulk_insert:
+                # the database doesn't return the primary keys of bulk inserted rows, look them up by the password
+                # hashes instead which are unique thanks to their random salt (unusable passwords are random too)
+                voter_ids = {}
+                for i in range(0, len(voters), BULK_CREATE_BATCH_SIZE):
+                    voter_ids.update(Voter.objects.filter(
+                        session=session,
+                        password__in=[voter.password for voter in voters[i:i + BULK_CREATE_BATCH_SIZE]],
+                    ).values_list('password', 'voter_id'))
+                for voter in voters:
+                    voter.voter_id = voter_ids[voter.password]
+
+            # add open elections from the session where the users were added
+            elections = [election for election in session.elections.all() if not election.closed]
+            OpenVote.objects.bulk_create([
+                OpenVote(election=election, voter=voter) for voter in voters for election in elections
+            ], batch_size=BULK_CREATE_BATCH_SIZE)
+
+        for voter in voters:
+            if voter._password is not None:
+                password_validation.password_changed(voter._password, voter)
+                voter._password = None
+        session.reset_vote_counters()
+        from vote.notifications import notify_reload  # pylint: disable=import-outside-toplevel
+        notify_reload("Login-Session-" + str(session.pk), '#voterCard')
+
+        return [(voter, password and cls.get_access_code(voter.voter_id, password))
+                for voter, password in zip(voters, passwords)]
+
     def new_access_token(self):
         password = self.set_password()
         self.logged_in = False
@@ -517,13 +737,35 @@ class Application(models.Model):
                                                'image/jpeg', sys.getsizeof(output), None)
             self._old_avatar = self.avatar
 
+        adding = self._state.adding
         super().save(force_insert, force_update, using, update_fields)
+        if adding:
+            Tally.objects.create(application=self)
+        Election.invalidate_cards(self.election_id)
+        if adding:
+            self.voter_flags_changed()
+
+    def delete(self, using=None, keep_parents=False):
+        result = super().delete(using, keep_parents)
+        Election.invalidate_cards(self.election_id)
+        self.voter_flags_changed()
+        return result
+
+    def voter_flags_changed(self):
+        # the voter gets another variant of the election card
+        if self.voter_id is not None:
+            from vote.notifications import notify_voter_flags_changed  # pylint: disable=import-outside-toplevel
+            voter_id, election_id = self.voter_id, self.election_id
+            transaction.on_commit(lambda: notify_voter_flags_changed(voter_id, election_id))
 
 
 class OpenVote(models.Model):
     election = models.ForeignKey(Election, related_name='open_votes', on_delete=models.CASCADE)
     voter = models.ForeignKey(Voter, related_name='open_votes', on_delete=models.CASCADE)
 
+    class Meta:
+        unique_together = ('voter', 'election')
+
     def can_vote(self, voter_id, election_id):
         return self.objects.filter(voter_id=voter_id, election_id=election_id).exists()
 
@@ -534,3 +776,40 @@ class Vote(models.Model):
     vote = models.CharField(choices=VOTE_CHOICES, max_length=max(len(x[0]) for x in VOTE_CHOICES))
     # save method is not called on bulk_create in forms.VoteForm.
     # The model update listener for websockets is implemented in the form.
+
+    class Meta:
+        # counting the votes of an application per choice (rebuild_tallies) only needs this index
+        indexes = [models.Index(fields=['candidate', 'vote'], name='vote_candidate_vote_idx')]
+
+
+class Tally(models.Model):
+    """
+    Number of votes per choice for an application.
+
+    Updated together with the Vote rows whenever a ballot is submitted, so election results can be read without
+    aggregating the whole Vote table. Use the rebuild_tallies management command to verify or rebuild the tallies
+    from the raw votes.
+    """
+    application = models.OneToOneField(Application, related_name='tally', on_delete=models.CASCADE)
+    votes_accept = models.PositiveIntegerField(default=0)
+    votes_reject = models.PositiveIntegerField(default=0)
+    votes_abstention = models.PositiveIntegerField(default=0)
+
+    @staticmethod
+    def count_ballot(votes: List['Vote']):
+        """
+        Add the votes of a single ballot to the tallies of their candidates.
+        Has to run in the same transaction that stores the votes.
+        """
+        increments = {}
+        for choice, field in TALLY_FIELDS.items():
+            candidates = [vote.candidate_id for vote in votes if vote.vote == choice]
+            if candidates:
+                increments[field] = F(field) + Case(When(application_id__in=candidates, then=Value(1)),
+                                                    default=Value(0))
+        if increments:
+            tallies = Tally.objects.filter(application_id__in=[vote.candidate_id for vote in votes])
+            # the UPDATE locks the rows in whatever order the database scans them, lock them sorted first so that
+            # concurrent ballots for the same candidates wait for each other instead of deadlocking
+            list(tallies.select_for_update().order_by('pk').values_list('pk', flat=True))
+            tallies.update(**increments)
@@ -0,0 +1,257 @@
+import asyncio
+import atexit
+import logging
+import os
+import threading
+import time
+from functools import partial
+from typing import Callable, Dict, Hashable, Optional, Set, Tuple, Union
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from vote.models import Election
+from vote.selectors import election_section
+from wahlfang import metrics
+
+logger = logging.getLogger(__name__)
+
+# a message, or a function that builds it when it is sent and returns None if there is nothing to send anymore
+Message = Union[dict, Callable[[], Optional[dict]]]
+
+# the most recent message per (group, key) that waits for its flush
+_pending: Dict[Tuple[str, Hashable], Message] = {}
+_pending_lock = threading.Lock()
+# event loop of the websockets of this process, see use_loop()
+_server_loop: Optional[asyncio.AbstractEventLoop] = None
+# event loop of the flush thread of this process, see _flush_loop()
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_pid: Optional[int] = None
+_loop_lock = threading.Lock()
+# running flushes, referenced until they are done so they are not garbage collected
+_tasks: Set[asyncio.Task] = set()
+
+
+def notify(group: str, message: Message, key: Hashable = None):
+    """
+    Send a message to all sockets of a channel group.
+
+    Messages with a key are coalesced: all messages for the same (group, key) that arrive within
+    NOTIFICATION_COALESCE_WINDOW seconds result in a single group_send carrying the most recent message. A message
+    that is expensive to build can be passed as a function, it is only called for the message that is sent.
+    """
+    window = getattr(settings, 'NOTIFICATION_COALESCE_WINDOW', 0)
+    if key is None or window <= 0:
+        _send(group, message)
+        return
+
+    loop = _flush_loop()
+    with _pending_lock:
+        scheduled = (group, key) in _pending
+        _pending[(group, key)] = message
+    if scheduled:
+        return
+
+    loop.call_soon_threadsafe(loop.call_later, window, _start_flush, (group, key))
+
+
+def flush():
+    """
+    Send all coalesced messages now instead of at the end of their window. Called before the process exits.
+    """
+    with _pending_lock:
+        pending = list(_pending.items())
+        _pending.clear()
+    # built and sent from this thread, no new threads can be started while the interpreter shuts down
+    for (group, _), message in pending:
+        try:
+            _send(group, message)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Could not send a notification to %s', group)
+
+
+atexit.register(flush)
+
+
+def use_loop(loop: asyncio.AbstractEventLoop):
+    """
+    Send the messages from the event loop of the websockets of this process, called by the consumers. The in-memory
+    channel layer only wakes up a websocket from its own loop, channels_redis works from any loop.
+    """
+    global _server_loop  # pylint: disable=global-statement
+    _server_loop = loop
+
+
+def _flush_loop() -> asyncio.AbstractEventLoop:
+    """
+    Return the event loop of the flush thread of this process, which is started on first use.
+
+    A single long-lived loop sends all messages that are not sent from the loop of the websockets, so channels_redis
+    keeps one connection pool for them. A forked process starts its own thread, the flushes scheduled in the thread
+    of its parent would never run.
+    """
+    global _loop, _loop_pid  # pylint: disable=global-statement
+    with _loop_lock:
+        if _loop is None or _loop_pid != os.getpid():
+            with _pending_lock:
+                _pending.clear()
+            _loop = asyncio.new_event_loop()
+            _loop_pid = os.getpid()
+            threading.Thread(target=_loop.run_forever, name='notifications', daemon=True).start()
+        return _loop
+
+
+def _start_flush(pending_key: Tuple[str, Hashable]):
+    task = asyncio.ensure_future(_flush(pending_key))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+async def _flush(pending_key: Tuple[str, Hashable]):
+    with _pending_lock:
+        message = _pending.pop(pending_key, None)
+    if message is None:
+        # already sent by flush()
+        return
+    try:
+        if callable(message):
+            # not in the thread of the sync code of the websockets, which would wait for it
+            message = await database_sync_to_async(message, thread_sensitive=False)()
+        if message is not None:
+            await _deliver(pending_key[0], message)
+    except Exception:  # pylint: disable=broad-except
+        logger.exception('Could not send a notification to %s', pending_key[0])
+
+
+async def _deliver(group: str, message: dict):
+    loop = _server_loop
+    if loop is not None and loop.is_running() and loop is not asyncio.get_running_loop():
+        await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(_group_send(group, message), loop))
+    else:
+        await _group_send(group, message)
+
+
+def _send(group: str, message: Message):
+    if callable(message):
+        message = message()
+        if message is None:
+            return
+    asyncio.run_coroutine_threadsafe(_deliver(group, message), _flush_loop()).result()
+
+
+async def _group_send(group: str, message: dict):
+    # the consumers measure the time until the message reached the browser from here, see ConsumerMetricsMixin
+    message = {**message, 'sent': time.time()}
+    with metrics.GROUP_SEND_SECONDS.labels(metrics.group_kind(group)).time():
+        await get_channel_layer().group_send(group, message)
+
+
+def render_election_cards(election) -> dict:
+    """
+    Render every variant of the election card that is shown to the members of a session group.
+
+    The cards are rendered once per change and shipped to all sockets of the group, each consumer picks the
+    variant that matches its page. Voter cards depend on whether the voter can still vote and whether they
+    applied, so only the combinations that actually differ for the current state of the election are rendered.
+    They are keyed by '<can_vote><edit>', e.g. '10' for a voter that can vote and has not applied, see
+    vote.consumers.VoteConsumer.voter_card().
+    """
+    can_vote_values = (False, True) if election.is_open else (False,)
+    edit_values = (False, True) if election.voters_self_apply and election.can_apply else (False,)
+    voter_cards = {
+        f'{int(can_vote)}{int(edit)}': render_to_string('vote/index_election_item.html', context={
+            'election': election,
+            'can_vote': can_vote,
+            'edit': edit,
+        })
+        for can_vote in can_vote_values for edit in edit_values
+    }
+
+    return {
+        'voter': voter_cards,
+        'spectator': render_to_string('vote/spectator_election_item.html', context={'election': election}),
+        'management': render_to_string('management/session_election_item.html', context={'election': election}),
+    }
+
+
+def _election_message(election_id) -> Optional[dict]:
+    election = Election.objects.filter(pk=election_id).first()
+    if election is None:
+        # deleted in the meantime, the deletion is sent with the same key
+        return None
+    return {
+        'type': 'send_election',
+        'id': election.pk,
+        'section': election_section(election, timezone.now()),
+        'cards': render_election_cards(election),
+    }
+
+
+def notify_election_changed(election):
+    """
+    Push the freshly rendered election card to all pages of the election's session. The cards are rendered when
+    the message is sent, once for all changes of the election within the coalesce window.
+    """
+    notify("Session-" + str(election.session_id), partial(_election_message, election.pk),
+           key=('election', election.pk))
+
+
+def notify_election_deleted(election):
+    """
+    Tell all pages of the election's session to drop the election card.
+    """
+    notify(
+        "Session-" + str(election.session_id),
+        {'type': 'send_election', 'id': election.pk, 'section': None, 'cards': None},
+        key=('election', election.pk)
+    )
+
+
+def voter_group(voter_id) -> str:
+    return f'Voter-{voter_id}'
+
+
+def notify_voter_flags_changed(voter_id, election_id):
+    """
+    Tell the pages of a voter that they voted or changed their application in an election, so they pick another
+    variant of its card, see vote.consumers.VoteConsumer.voter_card().
+    """
+    notify(voter_group(voter_id), {'type': 'forget_voter_flags', 'id': election_id})
+
+
+def notify_vote_counters(election, counters: dict):
+    """
+    Update the vote counters shown on the manager's election page.
+    """
+    notify("Election-" + str(election.pk), {'type': 'send_counters', 'counters': counters}, key='counters')
+
+
+def connected_voters_group(session_id) -> str:
+    # no messages are sent to this group, it only counts the websockets of the voters of a session
+    return f'Voters-Session-{session_id}'
+
+
+def connected_voters(session_id) -> int:
+    # websockets, not distinct voters
+    return metrics.group_size(connected_voters_group(session_id))
+
+
+def notify_connected_voters(session_id):
+    """
+    Update the number of connected voters shown on the manager's session page.
+    """
+    notify(
+        "Login-Session-" + str(session_id),
+        {'type': 'send_counters', 'counters': {'connected_voters': connected_voters(session_id)}},
+        key='connected_voters'
+    )
+
+
+def notify_reload(group: str, element_id: str):
+    """
+    Tell all pages of a group to reload the element with the given html id.
+    """
+    notify(group, {'type': 'send_reload', 'id': element_id}, key=('reload', element_id))
@@ -1,31 +1,87 @@
-from django.db.models import Q
+from typing import Dict, List
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Prefetch, Q, prefetch_related_objects
 from django.utils import timezone
 
-from vote.models import Election, Session
+from vote.models import Application, Election, Session, session_elections_cache_key
 
 
-def upcoming_elections(session: Session):
+def upcoming_elections(session: Session, now=None):
+    now = now or timezone.now()
     return Election.objects.filter(session=session).filter(
-        Q(start_date__gt=timezone.now()) | Q(start_date__isnull=True)
+        Q(start_date__gt=now) | Q(start_date__isnull=True)
     ).order_by('start_date')
 
 
-def open_elections(session: Session):
+def open_elections(session: Session, now=None):
+    now = now or timezone.now()
     return Election.objects.filter(session=session).filter(
-        Q(start_date__isnull=False, end_date__isnull=False, start_date__lte=timezone.now(), end_date__gt=timezone.now())
-        | Q(start_date__isnull=False, end_date__isnull=True, start_date__lte=timezone.now())
+        Q(start_date__isnull=False, end_date__isnull=False, start_date__lte=now, end_date__gt=now)
+        | Q(start_date__isnull=False, end_date__isnull=True, start_date__lte=now)
     ).order_by('-start_date')
 
 
-def _closed_elections(session: Session):
+def _closed_elections(session: Session, now=None):
+    now = now or timezone.now()
     return Election.objects.filter(session=session).filter(
-        Q(end_date__lte=timezone.now(), end_date__isnull=False)
+        Q(end_date__lte=now, end_date__isnull=False)
     ).order_by('-start_date')
 
 
-def published_elections(session: Session):
-    return _closed_elections(session).filter(result_published=True)
+def published_elections(session: Session, now=None):
+    return _closed_elections(session, now).filter(result_published=True)
+
+
+def closed_elections(session: Session, now=None):
+    return _closed_elections(session, now).filter(result_published=False)
+
+
+def election_section(election: Election, now=None) -> str:
+    """
+    Return the name of the selector bucket (upcoming, open, published or closed) the election is listed in.
+    """
+    now = now or timezone.now()
+    if election.end_date is not None and election.end_date <= now:
+        return 'published' if election.result_published else 'closed'
+    if election.start_date is not None and election.start_date <= now:
+        return 'open'
+    return 'upcoming'
+
+
+def _start_timestamp(election: Election) -> float:
+    # elections without start date are sorted like NULL values in PostgreSQL: last in ascending order
+    return election.start_date.timestamp() if election.start_date else float('inf')
+
+
+def session_elections(session: Session) -> List[Election]:
+    """
+    Return all elections of the session. The list is cached per session and invalidated by Election.save() and
+    Election.delete(), so repeatedly rendered pages of a session don't query the elections over and over again.
+    """
+    key = session_elections_cache_key(session.pk)
+    elections = cache.get(key)
+    if elections is None:
+        elections = list(Election.objects.filter(session=session))
+        cache.set(key, elections, timeout=settings.SESSION_ELECTIONS_CACHE_TIMEOUT)
+    return elections
+
 
+def partition_elections(session: Session, now=None) -> Dict[str, List[Election]]:
+    """
+    Sort all elections of the session into the upcoming, open, published and closed buckets of the selectors
+    above, evaluated at a single point in time. The elections come from the session's election cache, their
+    applications and tallies are prefetched with one query.
+    """
+    now = now or timezone.now()
+    elections = session_elections(session)
+    prefetch_related_objects(elections, Prefetch('applications', queryset=Application.objects.select_related('tally')))
+    buckets: Dict[str, List[Election]] = {'upcoming': [], 'open': [], 'published': [], 'closed': []}
+    for election in elections:
+        buckets[election_section(election, now)].append(election)
 
-def closed_elections(session: Session):
-    return _closed_elections(session).filter(result_published=False)
+    buckets['upcoming'].sort(key=_start_timestamp)
+    for section in ('open', 'published', 'closed'):
+        buckets[section].sort(key=_start_timestamp, reverse=True)
+    return buckets
@@ -2,6 +2,7 @@ $(document).ready(() => {
   let timeout;
 
   function reload_callback() {
+    add_csrf_token($(".election-item form[method=post]"));
     setup_date_reload();
   }
 
@@ -14,6 +15,72 @@ $(document).ready(() => {
     $(reload_id).load(location.pathname + " " + reload_id, reload_callback)
   }
 
+  function csrf_token() {
+    const match = document.cookie.match(/(?:^|;\s*)csrftoken=([^;]+)/);
+    return match ? match[1] : null;
+  }
+
+  function add_csrf_token(forms) {
+    // election cards are pushed to all pages of a session, so they are rendered without a csrf token
+    const token = csrf_token();
+    if (token) {
+      forms.each(function () {
+        if ($(this).find("input[name=csrfmiddlewaretoken]").length === 0) {
+          $(this).prepend($("<input type='hidden' name='csrfmiddlewaretoken'>").val(token));
+        }
+      });
+    }
+  }
+
+  function start_of(card) {
+    const start = $(card).attr("data-start");
+    return start ? Number(start) : Infinity;
+  }
+
+  function update_election(election) {
+    // replace a single election card with the fragment rendered by the server
+    $("#election-" + election.id).remove();
+    if (election.html) {
+      const card = $(election.html);
+      add_csrf_token(card.find("form[method=post]"));
+      const list = $("#" + election.section + "Elections .election-list");
+      // upcoming elections are sorted ascending by their start date, all others descending, elections without start
+      // date are last in ascending order (like in vote.selectors.partition_elections)
+      const start = start_of(card);
+      const ascending = election.section === "upcoming";
+      const next = list.children(".election-item").filter(function () {
+        return ascending ? start_of(this) > start : start_of(this) < start;
+      }).first();
+      if (next.length) {
+        next.before(card);
+      } else {
+        list.append(card);
+      }
+    }
+    $(".election-section").each(function () {
+      $(this).toggleClass("d-none", $(this).find(".election-item").length === 0);
+    });
+    $("#noElections").toggleClass("d-none", $(".election-item").length > 0);
+    setup_date_reload();
+  }
+
+  function update_progress(progress) {
+    // progress of a voter import or token sheet running in the background
+    const item = $("#" + progress.id);
+    if (progress.done >= progress.total) {
+      item.remove();
+      return;
+    }
+    if (item.length === 0) {
+      reload("#backgroundTasks");
+      return;
+    }
+    item.find(".progress-bar")
+      .css("width", Math.floor(100 * progress.done / progress.total) + "%")
+      .attr("aria-valuenow", progress.done)
+      .text(progress.done + " / " + progress.total);
+  }
+
   function setup_date_reload() {
     //setup a timer to reload the page if a start or end date of a election passed
     clearTimeout(timeout);
@@ -33,6 +100,14 @@ $(document).ready(() => {
       const message = JSON.parse(e.data)
       if (message.reload) {
         reload(message.reload);
+      }else if (message.election){
+        update_election(message.election);
+      }else if (message.counters){
+        for (const [name, value] of Object.entries(message.counters)) {
+          $("[data-counter=" + name + "]").text(value);
+        }
+      }else if (message.progress){
+        update_progress(message.progress);
       }else if (message.alert){
         if (message.alert.reload)
           // we want to reload the voters because the list might be outdated due to the deletion of
@@ -62,6 +137,7 @@ $(document).ready(() => {
   //$('#alertModal').on('hidden.bs.modal', function (e) {
   //  reload();
   //});
+  add_csrf_token($(".election-item form[method=post]"));
   setup_date_reload();
   setup_websocket();
 })
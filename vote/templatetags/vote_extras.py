@@ -1,6 +1,8 @@
 import random
 
 from django import template
+from django.conf import settings
+from django.templatetags.cache import CacheNode
 
 register = template.Library()
 
@@ -15,3 +17,28 @@ def shuffle(items):
     items = list(items)[:]
     random.shuffle(items)
     return items
+
+
+@register.tag
+def cache_election_card(parser, token):
+    """
+    Cache a part of an election card until the election changes (see Election.card_version), like {% cache %}:
+
+        {% cache_election_card "fragment_name" election [var1] [var2] ... %} ... {% endcache_election_card %}
+
+    The fragment is rendered once for all pages that show the same variant of the card.
+    """
+    nodelist = parser.parse(('endcache_election_card',))
+    parser.delete_first_token()
+    tokens = token.split_contents()
+    if len(tokens) < 3:
+        raise template.TemplateSyntaxError(f"'{tokens[0]}' tag requires at least 2 arguments.")
+    election = tokens[2]
+    vary_on = [f'{election}.pk', f'{election}.card_version'] + tokens[3:]
+    return CacheNode(
+        nodelist,
+        parser.compile_filter(str(settings.ELECTION_CARD_CACHE_TIMEOUT)),
+        tokens[1].strip('"\''),
+        [parser.compile_filter(var) for var in vary_on],
+        None,
+    )
@@ -1,11 +1,39 @@
+import asyncio
+import threading
+import time
+from io import StringIO
 from datetime import timedelta, datetime
+from unittest import mock
 
-from django.test import TestCase
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import InMemoryChannelLayer
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.hashers import make_password
+from django.core.cache import cache
+from django.conf import settings
+from django.core.management import call_command, CommandError
+from django.db import OperationalError, connection
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.template.loader import render_to_string
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 from django.utils import timezone
+from django.utils.html import strip_tags
 from freezegun import freeze_time
 
-from vote.models import Election, Enc32, Voter, Session
-from vote.selectors import closed_elections, open_elections, published_elections, upcoming_elections
+from management.consumers import ElectionConsumer, SessionConsumer
+from management.forms import AddElectionForm
+from management.models import ElectionManager
+from vote import checks, notifications
+from vote.authentication import AccessCodeBackend
+from vote.consumers import VoteConsumer
+from vote.forms import VoteForm
+from vote.mails import InvitationRenderer, ReminderRenderer
+from vote.models import Application, Election, Enc32, OpenVote, Vote, Voter, Session, Tally, VOTE_ACCEPT, VOTE_REJECT, \
+    VOTE_ABSTENTION
+from vote.selectors import closed_elections, open_elections, published_elections, upcoming_elections, \
+    partition_elections
+from wahlfang import metrics
 
 
 class Enc32TestCase(TestCase):
@@ -25,6 +53,56 @@ class VoterTestCase(TestCase):
             self.assertEqual(voter_id, ret_voter_id)
             self.assertEqual(raw_password, ret_password)
 
+    def test_access_code_hash_upgrade(self):
+        session = Session.objects.create(title='Test session')
+        voter = Voter(session=session)
+        password = voter.set_password()
+        self.assertTrue(voter.password.startswith('access_code_hmac_sha256$'))
+        self.assertTrue(voter.check_password(password))
+        self.assertFalse(voter.check_password(password[:-1]))
+
+        # codes hashed by older versions are rehashed on login
+        voter.password = make_password(password, hasher='pbkdf2_sha256')
+        voter.save()
+        self.assertTrue(voter.check_password(password))
+        voter.refresh_from_db()
+        self.assertTrue(voter.password.startswith('access_code_hmac_sha256$'))
+        self.assertTrue(voter.check_password(password))
+
+    def test_bulk_from_data(self):
+        session = Session.objects.create(title='Test session')
+        election = Election.objects.create(session=session)
+        Election.objects.create(session=session, start_date=timezone.now() - timedelta(days=2),
+                                end_date=timezone.now() - timedelta(days=1))
+        rows = [{'email': f'voter{i}@example.com', 'name': f'Voter {i}'} for i in range(20)] + [{}, {}]
+
+        voters_codes = Voter.bulk_from_data(session, rows)
+
+        self.assertEqual(session.participants.count(), 22)
+        for voter, access_code in voters_codes:
+            user = AccessCodeBackend().authenticate(None, access_code=access_code)
+            self.assertEqual(user, voter)
+            self.assertEqual(list(user.open_votes.values_list('election_id', flat=True)), [election.pk])
+
+    def test_user_cache(self):
+        session = Session.objects.create(title='Test session')
+        voter, access_code = Voter.from_data(session=session, name='Voter')
+        backend = AccessCodeBackend()
+        backend.get_user(voter.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(backend.get_user(voter.pk).session.title, 'Test session')
+
+        session.title = 'Renamed'
+        session.save()
+        self.assertEqual(backend.get_user(voter.pk).session.title, 'Renamed')
+        # a new access code invalidates the login sessions of the old one
+        voter.new_access_token()
+        self.assertEqual(backend.get_user(voter.pk).password, voter.password)
+        self.assertIsNone(backend.authenticate(None, access_code=access_code))
+
+        session.delete()
+        self.assertIsNone(backend.get_user(voter.pk))
+
 
 class ElectionSelectorsTest(TestCase):
     def test_election_selectors(self) -> None:
@@ -33,7 +111,10 @@ class ElectionSelectorsTest(TestCase):
         before = now - timedelta(seconds=5)
         bbefore = now - timedelta(seconds=10)
         after = now + timedelta(seconds=5)
-        freeze_time(now).start()
+        freezer = freeze_time(now)
+        freezer.start()
+        # later tests wait for real timers, e.g. of the coalesced notifications
+        self.addCleanup(freezer.stop)
 
         session = Session.objects.create(title="TEST")
         # upcoming elections
@@ -87,6 +168,545 @@ class ElectionSelectorsTest(TestCase):
             self.assertTrue(
                 e.started and e.closed and not e.is_open and not e.result_published)
 
+        # test the single-pass partitioning
+        partition = partition_elections(session)
+        self.assertEqual(all_upcoming, set(partition['upcoming']))
+        self.assertEqual(all_opened, set(partition['open']))
+        self.assertEqual(all_published, set(partition['published']))
+        self.assertEqual(all_closed, set(partition['closed']))
+
+        # the cached elections of the session are invalidated on save
+        election = partition['upcoming'][0]
+        election.start_date = before
+        election.save()
+        self.assertIn(election, partition_elections(session)['open'])
+
+
+class NotificationCoalescingTest(TestCase):
+    # long enough that nothing is sent before flush()
+    @override_settings(NOTIFICATION_COALESCE_WINDOW=60)
+    def test_coalesce_identical_events(self):
+        with mock.patch.object(notifications, 'get_channel_layer') as get_channel_layer:
+            send = get_channel_layer.return_value.group_send = mock.AsyncMock()
+            for i in range(50):
+                notifications.notify('Coalesce-1', {'type': 'send_reload', 'id': '#voterCard', 'n': i},
+                                     key='#voterCard')
+            notifications.notify('Coalesce-2', {'type': 'send_reload', 'id': '#voterCard'}, key='#voterCard')
+            notifications.flush()
+
+        # flush() also sends the notifications of other tests that are still pending
+        calls = [c for c in send.call_args_list if c.args[0].startswith('Coalesce-')]
+        self.assertCountEqual(calls, [
+            mock.call('Coalesce-1', {'type': 'send_reload', 'id': '#voterCard', 'n': 49, 'sent': mock.ANY}),
+            mock.call('Coalesce-2', {'type': 'send_reload', 'id': '#voterCard', 'sent': mock.ANY}),
+        ])
+
+    def test_coalesced_message_reaches_websocket(self):
+        async def receive():
+            # a group that no other test sends to
+            communicator = WebsocketCommunicator(ElectionConsumer.as_asgi(), '/management/election/1001')
+            communicator.scope['url_route'] = {'kwargs': {'pk': '1001'}}
+            await communicator.connect()
+            for _ in range(3):
+                await sync_to_async(notifications.notify_reload)('Election-1001', '#backgroundTasks')
+            start = time.monotonic()
+            message = await communicator.receive_json_from(timeout=2)
+            elapsed = time.monotonic() - start
+            nothing_else = await communicator.receive_nothing(timeout=2 * settings.NOTIFICATION_COALESCE_WINDOW)
+            await communicator.disconnect()
+            return message, elapsed, nothing_else
+
+        message, elapsed, nothing_else = async_to_sync(receive)()
+        self.assertEqual(message, {'reload': '#backgroundTasks'})
+        self.assertLess(elapsed, 1)
+        self.assertTrue(nothing_else)
+
+    @override_settings(NOTIFICATION_COALESCE_WINDOW=60)
+    def test_failed_flush_is_logged(self):
+        with mock.patch.object(notifications, 'get_channel_layer') as get_channel_layer, \
+                self.assertLogs('vote.notifications', 'ERROR'):
+            get_channel_layer.return_value.group_send = mock.AsyncMock(side_effect=ConnectionError)
+            notifications.notify('Coalesce-3', {'type': 'send_reload', 'id': '#voterCard'}, key='#voterCard')
+            notifications.flush()
+
+    @override_settings(NOTIFICATION_COALESCE_WINDOW=0)
+    def test_no_window_sends_immediately(self):
+        with mock.patch.object(notifications, '_send') as send:
+            notifications.notify('Session-1', {'type': 'send_reload', 'id': '#electionCard'}, key='#electionCard')
+            notifications.notify('Session-1', {'type': 'send_reload', 'id': '#electionCard'}, key='#electionCard')
+
+        self.assertEqual(send.call_count, 2)
+
+
+class ChannelLayerTest(TestCase):
+    def test_deploy_check(self):
+        self.assertEqual([warning.id for warning in checks.check_shared_backends(None)], ['vote.W001', 'vote.W002'])
+        with override_settings(
+                CHANNEL_LAYERS={'default': {'BACKEND': 'channels_redis.core.RedisChannelLayer'}},
+                CACHES={'default': {'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
+                                    'LOCATION': '127.0.0.1:11211'}}
+        ):
+            self.assertEqual(checks.check_shared_backends(None), [])
+
+    @mock.patch('channels.db.close_old_connections')
+    def test_shared_layer_fan_out_across_threads(self, _):
+        layers = {'default': {'BACKEND': 'vote.tests.SharedChannelLayer'}}
+        connected = threading.Barrier(3)
+        received = []
+
+        async def serve():
+            # an event loop of its own with two websockets
+            communicators = []
+            for _ in range(2):
+                communicator = WebsocketCommunicator(SessionConsumer.as_asgi(), '/management/meeting/1003')
+                communicator.scope['url_route'] = {'kwargs': {'pk': '1003'}}
+                await communicator.connect()
+                communicators.append(communicator)
+            await sync_to_async(connected.wait, thread_sensitive=False)()
+            for communicator in communicators:
+                received.append(await communicator.receive_json_from(timeout=5))
+                await communicator.disconnect()
+
+        with override_settings(CHANNEL_LAYERS=layers):
+            servers = [threading.Thread(target=asyncio.run, args=(serve(),)) for _ in range(2)]
+            for server in servers:
+                server.start()
+            connected.wait(timeout=5)
+            # from a thread without event loop, like the email workers
+            notifications.notify('Session-1003', {'type': 'send_reload', 'id': '#electionCard'}, key='#electionCard')
+            for server in servers:
+                server.join()
+
+        self.assertEqual(received, [{'reload': '#electionCard'}] * 4)
+
+
+class SharedChannelLayer(InMemoryChannelLayer):
+    """
+    In-memory channel layer that is shared by event loops in several threads of the test process, messages are put
+    into the queues on the loop of their receiver.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.loops = {}
+
+    async def receive(self, channel):
+        self.loops[channel] = asyncio.get_running_loop()
+        return await super().receive(channel)
+
+    async def send(self, channel, message):
+        loop = self.loops.get(channel, asyncio.get_running_loop())
+        if loop is asyncio.get_running_loop():
+            await super().send(channel, message)
+        else:
+            await asyncio.wrap_future(
+                asyncio.run_coroutine_threadsafe(InMemoryChannelLayer.send(self, channel, message), loop))
+
+    async def group_send(self, group, message):
+        # the websockets of the other loops leave the group while the message is sent
+        for channel in list(self.groups.get(group, {})):
+            await self.send(channel, message)
+
+
+class MetricsTest(TestCase):
+    def test_connections_of_dead_processes_expire(self):
+        cache.set(metrics.PROCESSES_KEY, {'other-process'})
+        cache.set(metrics.process_connections_key('other-process'), {'Election-1002': 5})
+        metrics.groups_connected(['Election-1002'])
+        self.assertEqual(metrics.group_size('Election-1002'), 6)
+
+        # the other process was killed and could not publish its counts anymore
+        cache.delete(metrics.process_connections_key('other-process'))
+        self.assertEqual(metrics.group_size('Election-1002'), 1)
+        metrics.groups_disconnected(['Election-1002'])
+        self.assertEqual(metrics.group_size('Election-1002'), 0)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+                                           'LOCATION': 'metrics_test_cache'}})
+    def test_notify_with_database_cache(self):
+        call_command('createcachetable', verbosity=0)
+        with mock.patch.object(notifications, 'get_channel_layer') as get_channel_layer:
+            send = get_channel_layer.return_value.group_send = mock.AsyncMock()
+            notifications.notify('Session-1', {'type': 'send_reload', 'id': '#electionCard'})
+        send.assert_awaited_once()
+
+    def test_cached_counts(self):
+        session = Session.objects.create(title='TEST')
+        Voter.objects.create(session=session, logged_in=True)
+        Voter.objects.create(session=session)
+
+        cache.set(metrics.PROCESSES_KEY, {'other-process'})
+        cache.set(metrics.process_connections_key('other-process'), {'Fan-Out-1': 2, 'Fan-Out-2': 4})
+        metrics.groups_connected(['Fan-Out-1', 'Fan-Out-1', 'Fan-Out-1'])
+
+        collector = metrics.WahlfangCollector()
+        samples = {metric.name: metric.samples for metric in collector.collect()}
+        self.assertEqual(samples['wahlfang_session_count'][0].value, 1)
+        self.assertEqual(samples['wahlfang_active_voters'][0].labels, {'session': str(session.pk)})
+        self.assertEqual(samples['wahlfang_active_voters'][0].value, 1)
+        fan_out = {sample.labels['group']: sample.value for sample in samples['wahlfang_group_fan_out']}
+        self.assertEqual(fan_out['Fan-Out'], 5)
+        with self.assertNumQueries(0):
+            collector.collect()
+        metrics.groups_disconnected(['Fan-Out-1', 'Fan-Out-1', 'Fan-Out-1'])
+
+
+class TallyTest(TestCase):
+    def setUp(self):
+        self.session = Session.objects.create(title='TEST')
+        self.election = Election.objects.create(session=self.session, start_date=timezone.now())
+        self.applications = [
+            Application.objects.create(election=self.election, display_name=f'candidate {i}') for i in range(3)
+        ]
+
+    def cast(self, choices):
+        voter, _ = Voter.from_data(session=self.session)
+        request = RequestFactory().post('/')
+        request.user = voter
+        form = VoteForm(request, election=self.election, data={
+            str(application.pk): choice for application, choice in zip(self.applications, choices)
+        })
+        self.assertTrue(form.is_valid(), form.errors)
+        form.save()
+
+    def test_tally_matches_votes(self):
+        self.cast([VOTE_ACCEPT, VOTE_REJECT, VOTE_ABSTENTION])
+        self.cast([VOTE_ACCEPT, VOTE_ACCEPT, VOTE_ABSTENTION])
+        self.election.end_date = timezone.now()
+        self.election.save()
+
+        summary = {a.pk: (a.votes_accept, a.votes_reject, a.votes_abstention) for a in self.election.election_summary}
+        self.assertEqual(summary, {
+            self.applications[0].pk: (2, 0, 0),
+            self.applications[1].pk: (1, 1, 0),
+            self.applications[2].pk: (0, 0, 2),
+        })
+        call_command('rebuild_tallies', verify=True, stdout=StringIO())
+
+    def test_ballot_is_stored_once(self):
+        voter, _ = Voter.from_data(session=self.session)
+        request = RequestFactory().post('/')
+        request.user = voter
+        data = {str(application.pk): VOTE_ACCEPT for application in self.applications}
+        forms = [VoteForm(request, election=self.election, data=data) for _ in range(2)]
+        self.assertTrue(all(form.is_valid() for form in forms))
+
+        self.assertIsNotNone(forms[0].save())
+        self.assertIsNone(forms[1].save())
+        self.assertTrue(forms[1].non_field_errors())
+        self.assertEqual(self.election.votes.count(), len(self.applications))
+        self.assertEqual(Tally.objects.get(application=self.applications[0]).votes_accept, 1)
+
+    def test_counters_after_slow_count(self):
+        self.cast([VOTE_ACCEPT, VOTE_REJECT, VOTE_ABSTENTION])
+        self.election.reset_vote_counters()
+        count_votes = Election._count_votes
+        cast = []
+
+        def count_before_ballot(election):
+            # a page view counts the votes, then a ballot is cast before the page stores the counts
+            counters = count_votes(election)
+            if not cast:
+                cast.append(True)
+                self.cast([VOTE_ACCEPT, VOTE_ACCEPT, VOTE_ACCEPT])
+            return counters
+
+        with mock.patch.object(Election, '_count_votes', count_before_ballot):
+            self.assertEqual(self.election.vote_counters()['cast'], 1)
+        self.assertEqual(self.election.vote_counters(), {'voters': 2, 'cast': 2, 'open': 0})
+
+    def test_rebuild_tallies(self):
+        self.cast([VOTE_ACCEPT, VOTE_REJECT, VOTE_ABSTENTION])
+        Tally.objects.filter(application=self.applications[0]).update(votes_accept=5)
+        Tally.objects.filter(application=self.applications[1]).delete()
+
+        with self.assertRaises(CommandError):
+            call_command('rebuild_tallies', verify=True, stdout=StringIO())
+        call_command('rebuild_tallies', stdout=StringIO())
+        call_command('rebuild_tallies', verify=True, stdout=StringIO())
+        self.assertEqual(Tally.objects.get(application=self.applications[0]).votes_accept, 1)
+        self.assertEqual(Tally.objects.get(application=self.applications[1]).votes_reject, 1)
+
+
+# the election cards are rendered when they are sent, not after the test database is gone
+@override_settings(NOTIFICATION_COALESCE_WINDOW=0)
+class ConcurrentBallotTest(TransactionTestCase):
+    def test_double_submits(self):
+        session = Session.objects.create(title='TEST')
+        election = Election.objects.create(session=session, start_date=timezone.now())
+        applications = [Application.objects.create(election=election, display_name=f'candidate {i}') for i in range(3)]
+        Voter.objects.bulk_create([Voter(session=session, password='!') for _ in range(20)])
+        voter_ids = list(Voter.objects.filter(session=session).values_list('pk', flat=True))
+        OpenVote.objects.bulk_create([OpenVote(election=election, voter_id=voter_id) for voter_id in voter_ids])
+
+        # every voter submits twice at the same time, from two threads
+        barrier = threading.Barrier(2)
+        stored = []
+        errors = []
+
+        def submit(voter_id, choices):
+            try:
+                barrier.wait()
+                votes = [Vote(election=election, candidate=application, vote=choice)
+                         for application, choice in zip(applications, choices)]
+                while True:
+                    try:
+                        if election.cast_ballot(voter_id, votes):
+                            stored.append(voter_id)
+                        break
+                    except OperationalError as e:
+                        # the in-memory SQLite test database fails concurrent writers instead of letting them wait,
+                        # submit again like a voter would
+                        if connection.vendor != 'sqlite' or 'locked' not in str(e):
+                            raise
+            except Exception as e:  # pylint: disable=W0703
+                errors.append(e)
+            finally:
+                connection.close()
+
+        for voter_id in voter_ids:
+            threads = [
+                threading.Thread(target=submit, args=(voter_id, [VOTE_ACCEPT, VOTE_REJECT, VOTE_ABSTENTION])),
+                threading.Thread(target=submit, args=(voter_id, [VOTE_ACCEPT, VOTE_ACCEPT, VOTE_ACCEPT])),
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(stored), sorted(voter_ids))
+        self.assertFalse(election.open_votes.exists())
+        self.assertEqual(election.votes.count(), len(voter_ids) * len(applications))
+        call_command('rebuild_tallies', verify=True, stdout=StringIO())
+        tallies = Tally.objects.filter(application__election=election)
+        self.assertEqual(sum(t.votes_accept + t.votes_reject + t.votes_abstention for t in tallies),
+                         len(voter_ids) * len(applications))
+
+
+class ElectionCardCacheTest(TestCase):
+    def test_card_is_rendered_once(self):
+        session = Session.objects.create(title='TEST')
+        election = Election.objects.create(session=session, start_date=timezone.now() - timedelta(minutes=2),
+                                           end_date=timezone.now() - timedelta(minutes=1))
+        application = Application.objects.create(election=election, display_name='candidate')
+
+        def render():
+            return render_to_string('vote/spectator_election_item.html', context={
+                'election': Election.objects.get(pk=election.pk)
+            })
+
+        html = render()
+        with self.assertNumQueries(1):
+            self.assertEqual(render(), html)
+
+        application.display_name = 'renamed candidate'
+        application.save()
+        self.assertIn('renamed candidate', render())
+
+
+class SpectatorTest(TestCase):
+    def test_conditional_get(self):
+        session = Session.objects.create(title='TEST')
+        url = reverse('vote:spectator', kwargs={'uuid': session.create_spectator_token()})
+        election = Election.objects.create(session=session, title='first election')
+
+        response = self.client.get(url)
+        self.assertContains(response, 'first election')
+        etag = response['ETag']
+
+        # the snapshot and the session come from the cache
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # changed within the same second, which a Last-Modified date could not tell apart
+        election.title = 'renamed election'
+        election.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertFalse(response.has_header('Last-Modified'))
+        self.assertContains(response, 'renamed election')
+        self.assertNotEqual(response['ETag'], etag)
+
+        # the election starting changes the page without saving anything
+        election.start_date = timezone.now() + timedelta(minutes=1)
+        election.save()
+        etag = self.client.get(url)['ETag']
+        with freeze_time(timezone.now() + timedelta(minutes=2)):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+# the cards are rendered in the thread that sends them, which can't see the data of the test transaction otherwise
+@override_settings(NOTIFICATION_COALESCE_WINDOW=0)
+class ElectionPushTest(TestCase):
+    @staticmethod
+    async def receive_card(communicator, election):
+        while True:
+            message = await communicator.receive_json_from()
+            if message.get('election', {}).get('id') == election.pk:
+                return message['election']
+
+    def save_committed(self, obj):
+        # the cards are pushed when the transaction commits
+        with self.captureOnCommitCallbacks(execute=True):
+            return obj.save()
+
+    # database_sync_to_async would close the connection of the test transaction
+    @mock.patch('channels.db.close_old_connections')
+    def test_voter_receives_own_variant(self, _):
+        session = Session.objects.create(title='TEST')
+        election = Election.objects.create(session=session, start_date=timezone.now() - timedelta(minutes=1),
+                                           end_date=timezone.now() + timedelta(minutes=10))
+        voters = [Voter.objects.select_related('session').get(pk=Voter.objects.create(session=session).pk)
+                  for _ in range(2)]
+        OpenVote.objects.create(election=election, voter=voters[0])
+
+        async def push():
+            communicators = []
+            for voter in voters:
+                communicator = WebsocketCommunicator(VoteConsumer.as_asgi(), '/')
+                communicator.scope.update({'user': voter, 'url_route': {'kwargs': {}}})
+                await communicator.connect()
+                communicators.append(communicator)
+            election.title = 'renamed election'
+            await sync_to_async(self.save_committed)(election)
+            cards = [await self.receive_card(communicator, election) for communicator in communicators]
+            for communicator in communicators:
+                await communicator.disconnect()
+            return cards
+
+        cards = async_to_sync(push)()
+        self.assertEqual([card['section'] for card in cards], ['open', 'open'])
+        self.assertIn('renamed election', cards[0]['html'])
+        self.assertIn('Vote Now!', cards[0]['html'])
+        self.assertNotIn('Vote Now!', cards[1]['html'])
+
+    @mock.patch('channels.db.close_old_connections')
+    def test_voter_card_after_vote(self, _):
+        session = Session.objects.create(title='TEST')
+        election = Election.objects.create(session=session, start_date=timezone.now() - timedelta(minutes=1),
+                                           end_date=timezone.now() + timedelta(minutes=10))
+        application = Application.objects.create(election=election, display_name='candidate')
+        voter = Voter.objects.select_related('session').get(pk=Voter.from_data(session=session)[0].pk)
+        request = RequestFactory().post('/')
+        request.user = voter
+        form = VoteForm(request, election=election, data={str(application.pk): VOTE_ACCEPT})
+        self.assertTrue(form.is_valid(), form.errors)
+
+        def vote():
+            with self.captureOnCommitCallbacks(execute=True):
+                form.save()
+
+        async def push():
+            communicator = WebsocketCommunicator(VoteConsumer.as_asgi(), '/')
+            communicator.scope.update({'user': voter, 'url_route': {'kwargs': {}}})
+            await communicator.connect()
+            await sync_to_async(self.save_committed)(election)
+            before = await self.receive_card(communicator, election)
+            await sync_to_async(vote)()
+            await sync_to_async(self.save_committed)(election)
+            after = await self.receive_card(communicator, election)
+            await communicator.disconnect()
+            return before, after
+
+        before, after = async_to_sync(push)()
+        self.assertIn('Vote Now!', before['html'])
+        self.assertIn('Thank You For Your Vote!', after['html'])
+
+    @mock.patch('channels.db.close_old_connections')
+    def test_voter_can_vote_in_new_open_election(self, _):
+        session = Session.objects.create(title='TEST')
+        manager = ElectionManager.objects.create(username='manager')
+        manager.sessions.add(session)
+        voter = Voter.objects.select_related('session').get(pk=Voter.from_data(session=session)[0].pk)
+        now = timezone.localtime()
+        form = AddElectionForm(manager, session, RequestFactory().post('/'), data={
+            'title': 'new election',
+            'start_date': (now - timedelta(minutes=1)).strftime('%Y-%m-%d %H:%M:%S'),
+            'end_date': (now + timedelta(minutes=10)).strftime('%Y-%m-%d %H:%M:%S'),
+            'remind_text': '',
+        })
+        self.assertTrue(form.is_valid(), form.errors)
+
+        async def push():
+            communicator = WebsocketCommunicator(VoteConsumer.as_asgi(), '/')
+            communicator.scope.update({'user': voter, 'url_route': {'kwargs': {}}})
+            await communicator.connect()
+            election = await sync_to_async(self.save_committed)(form)
+            card = await self.receive_card(communicator, election)
+            await communicator.disconnect()
+            return card
+
+        card = async_to_sync(push)()
+        self.assertEqual(card['section'], 'open')
+        self.assertIn('Vote Now!', card['html'])
+
+
+class IndexQueriesTest(TestCase):
+    def setUp(self):
+        self.session = Session.objects.create(title='TEST')
+        self.voter, _ = Voter.from_data(session=self.session, email='voter@example.com')
+        self.client.force_login(self.voter, backend='vote.authentication.AccessCodeBackend')
+
+    def add_elections(self):
+        now = timezone.now()
+        elections = [
+            Election.objects.create(session=self.session, voters_self_apply=True),
+            Election.objects.create(session=self.session, start_date=now - timedelta(minutes=1)),
+            Election.objects.create(session=self.session, start_date=now - timedelta(minutes=2),
+                                    end_date=now - timedelta(minutes=1), result_published=True),
+            Election.objects.create(session=self.session, start_date=now - timedelta(minutes=2),
+                                    end_date=now - timedelta(minutes=1), result_published=False),
+        ]
+        for election in elections:
+            Application.objects.create(election=election, display_name='candidate')
+            Application.objects.create(election=election, display_name='other candidate')
+        Application.objects.create(election=elections[0], display_name='voter', voter=self.voter)
+
+    def count_index_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('vote:index'))
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_constant_number_of_queries(self):
+        # the logged in voter is cached after the first request
+        self.count_index_queries()
+        self.add_elections()
+        num_queries = self.count_index_queries()
+        for _ in range(5):
+            self.add_elections()
+        self.assertEqual(self.count_index_queries(), num_queries)
+
+
+class MailRendererTest(TestCase):
+    def test_matches_template(self):
+        session = Session.objects.create(title='TEST <session>', start_date=timezone.now())
+        election = Election.objects.create(session=session, title='Election & co', end_date=timezone.now())
+        for name in ('', 'Jane <b>"Doe"</b> & co'):
+            voter = Voter(session=session, name=name, email='voter@example.com')
+            login_url = f'https://{settings.URL}' + reverse('vote:link_login', kwargs={'access_code': 'abc-def'})
+            body = render_to_string('vote/mails/invitation.j2', context={
+                'voter': voter, 'session': session, 'base_url': f'https://{settings.URL}', 'login_url': login_url,
+                'access_code': 'abc-def',
+            })
+            self.assertEqual(InvitationRenderer.for_session(session).render(voter, 'abc-def'),
+                             (f'Invitation for {session.title}', strip_tags(body), body.replace('\n', '<br/>')))
+            body = render_to_string('vote/mails/start.j2', context={
+                'voter': voter, 'election': election,
+                'url': f'https://{settings.URL}' + reverse('vote:vote', kwargs={'election_id': election.pk}),
+            })
+            self.assertEqual(ReminderRenderer.for_election(election).render(voter),
+                             (f'{election.title} is now open', strip_tags(body), body.replace('\n', '<br/>')))
+
+        session.invite_text = 'Hi {name}, use <a href="{login_url}">{access_code}</a> at {start_time}'
+        voter = Voter(session=session, name='Jane', email='voter@example.com')
+        _, message, html_message = InvitationRenderer.for_session(session).render(voter, 'abc-def')
+        self.assertIn('<a href="https://', html_message)
+        self.assertEqual(message, f'Hi Jane, use abc-def at {timezone.localtime(session.start_date):%H:%M}')
+
 
 def gen_data():
     session = Session.objects.create(
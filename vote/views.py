@@ -1,20 +1,27 @@
+import hashlib
 import sys
+from typing import Tuple
 
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import authenticate, login, views as auth_views
-from django.http.response import HttpResponseNotFound
+from django.core.cache import cache
+from django.http import Http404
+from django.http.response import HttpResponse, HttpResponseNotFound
 from django.shortcuts import render, redirect, get_object_or_404
+from django.template.loader import render_to_string
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
 from django.utils.decorators import method_decorator
+from django.utils.http import quote_etag
 from ratelimit.decorators import ratelimit
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
 
 from vote.authentication import voter_login_required
 from vote.forms import AccessCodeAuthenticationForm, VoteForm, ApplicationUploadFormUser
-from vote.models import Election, Voter, Session
-from vote.selectors import open_elections, upcoming_elections, published_elections, closed_elections
+from vote.models import Election, Voter, Session, spectator_snapshot_cache_key
+from vote.notifications import notify
+from vote.selectors import partition_elections, session_elections
 
 
 class LoginView(auth_views.LoginView):
@@ -58,7 +65,7 @@ def code_login(request, access_code=None):
 
     if user.qr:
         group = "QR-Reload-" + str(user.session.pk)
-        async_to_sync(get_channel_layer().group_send)(
+        notify(
             group,
             {'type': 'send_reload', 'link': reverse('management:add_mobile_voter', args=[user.session.pk])}
         )
@@ -70,10 +77,14 @@ def code_login(request, access_code=None):
 def index(request):
     voter: Voter = request.user
     session = voter.session
+    # fetch the voter's state for all elections at once instead of querying it per election
+    open_vote_ids = set(voter.open_votes.values_list('election_id', flat=True))
+    applied_ids = set(voter.applications.values_list('election_id', flat=True))
+    elections = partition_elections(session)
 
     def list_elections(elections):
         return [
-            (e, voter.can_vote(e), voter.has_applied(e))
+            (e, e.is_open and e.pk in open_vote_ids, e.pk in applied_ids)
             for e in elections
         ]
 
@@ -81,11 +92,11 @@ def index(request):
         'title': session.title,
         'meeting_link': session.meeting_link,
         'voter': voter,
-        'existing_elections': (session.elections.count() > 0),
-        'open_elections': list_elections(open_elections(session)),
-        'upcoming_elections': list_elections(upcoming_elections(session)),
-        'published_elections': list_elections(published_elections(session)),
-        'closed_elections': list_elections(closed_elections(session)),
+        'existing_elections': any(elections.values()),
+        'open_elections': list_elections(elections['open']),
+        'upcoming_elections': list_elections(elections['upcoming']),
+        'published_elections': list_elections(elections['published']),
+        'closed_elections': list_elections(elections['closed']),
     }
 
     # overview
@@ -101,27 +112,19 @@ def vote(request, election_id):
         return HttpResponseNotFound('Election does not exists')
 
     can_vote = voter.can_vote(election)
-    if election.max_votes_yes is not None:
-        max_votes_yes = min(election.max_votes_yes,
-                            election.applications.all().count())
-    else:
-        max_votes_yes = election.applications.all().count()
+    form = VoteForm(request, election=election, data=request.POST if request.POST and can_vote else None)
+    if form.is_bound and form.is_valid() and form.save() is not None:
+        return redirect('vote:index')
 
     context = {
         'title': election.title,
         'election': election,
         'voter': voter,
         'can_vote': can_vote,
-        'max_votes_yes': max_votes_yes,
-        'form': VoteForm(request, election=election)
+        'max_votes_yes': min(form.max_votes_yes, form.num_applications),
+        'form': form
     }
 
-    if request.POST and can_vote:
-        form = VoteForm(request, election=election, data=request.POST)
-        if form.is_valid():
-            form.save()
-            return redirect('vote:index')
-
     return render(request, template_name='vote/vote.html', context=context)
 
 
@@ -180,16 +183,49 @@ def help_page(request):
     return render(request, template_name='vote/help.html')
 
 
-def spectator(request, uuid):
-    session = get_object_or_404(Session.objects, spectator_token=uuid)
+def spectator_snapshot(session: Session) -> Tuple[str, str]:
+    """
+    Return the ETag and the html of the spectator page of a session.
+
+    The page is rendered once per change and shared by all spectators. The ETag is built from the versions of the
+    election cards, so it changes whenever an election, its applications or its votes change and whenever an election
+    starts or ends. Computing it only touches the cache.
+    """
+    versions = [f'{election.pk}:{election.card_version}' for election in session_elections(session)]
+    digest = hashlib.sha256('|'.join([
+        str(session.pk), session.title, session.meeting_link or '', timezone.get_current_timezone_name(), *versions
+    ]).encode()).hexdigest()
+
+    key = spectator_snapshot_cache_key(session.pk)
+    snapshot = cache.get(key)
+    if snapshot is not None and snapshot[0] == digest:
+        return snapshot
 
+    elections = partition_elections(session)
     context = {
         'title': session.title,
         'meeting_link': session.meeting_link,
-        'existing_elections': (session.elections.count() > 0),
-        'open_elections': open_elections(session),
-        'upcoming_elections': upcoming_elections(session),
-        'published_elections': published_elections(session),
-        'closed_elections': closed_elections(session),
+        'existing_elections': any(elections.values()),
+        'open_elections': elections['open'],
+        'upcoming_elections': elections['upcoming'],
+        'published_elections': elections['published'],
+        'closed_elections': elections['closed'],
     }
-    return render(request, template_name='vote/spectator.html', context=context)
+    # rendered without the request, the page must not contain anything specific to the spectator who triggered it
+    snapshot = (digest, render_to_string('vote/spectator.html', context=context))
+    cache.set(key, snapshot, timeout=settings.ELECTION_CARD_CACHE_TIMEOUT)
+    return snapshot
+
+
+def spectator(request, uuid):
+    session = Session.get_by_spectator_token(uuid)
+    if session is None:
+        raise Http404('No such session')
+    etag, html = spectator_snapshot(session)
+    etag = quote_etag(etag)
+
+    # no Last-Modified: its resolution of whole seconds can't tell apart two versions of the same second
+    response = get_conditional_response(request, etag=etag, response=HttpResponse(html))
+    response['ETag'] = etag
+    patch_cache_control(response, public=True, max_age=settings.SPECTATOR_CACHE_MAX_AGE)
+    return response
@@ -0,0 +1,206 @@
+"""
+Prometheus metrics of wahlfang, exported at /metrics next to the HTTP metrics of django_prometheus.
+
+Counts that need the database are computed at most once per METRICS_CACHE_TIMEOUT seconds and shared through the
+cache, so frequent scrapes by several Prometheus servers don't query the database.
+"""
+import logging
+import os
+import socket
+import threading
+import uuid
+from typing import Dict, Iterable
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+from prometheus_client.core import GaugeMetricFamily
+
+VOTE_SAVE_SECONDS = Histogram(
+    'wahlfang_vote_save_seconds', 'Time to store a ballot, including the notification of the managers')
+LOGIN_HASH_SECONDS = Histogram(
+    'wahlfang_login_hash_seconds', 'Time to hash the access code of a login attempt')
+MAIL_SEND_SECONDS = Histogram(
+    'wahlfang_mail_send_seconds', 'Time to send an email to a voter')
+MAIL_FAILURES = Counter(
+    'wahlfang_mail_failures', 'Emails to voters that could not be sent')
+PDF_BUILD_SECONDS = Histogram(
+    'wahlfang_pdf_build_seconds', 'Time to build the PDF of a token sheet', ['renderer'],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60, 120, float('inf')))
+WEBSOCKET_CONNECTS = Counter(
+    'wahlfang_websocket_connects', 'Opened websocket connections', ['consumer'])
+WEBSOCKET_DISCONNECTS = Counter(
+    'wahlfang_websocket_disconnects', 'Closed websocket connections', ['consumer'])
+GROUP_SEND_SECONDS = Histogram(
+    'wahlfang_group_send_seconds', 'Time to hand a group message to the channel layer', ['group'])
+DROPPED_MESSAGES = Counter(
+    'wahlfang_dropped_messages', 'Group messages that were dropped because the channel of a websocket was full',
+    ['group'])
+CONNECTED_WEBSOCKETS = Gauge(
+    'wahlfang_connected_websockets', 'Websockets of this process that joined a group', ['group'])
+WEBSOCKET_MESSAGES = Counter(
+    'wahlfang_websocket_messages', 'Group messages handled by the websockets', ['consumer', 'type'])
+WEBSOCKET_SEND_SECONDS = Histogram(
+    'wahlfang_websocket_send_seconds', 'Time from sending a group message until a websocket sent it to the browser',
+    ['consumer'])
+
+
+def group_kind(group: str) -> str:
+    """
+    Name of a channel group without the primary key, e.g. 'Login-Session' for 'Login-Session-42'. The metrics are
+    labelled by kind, one label per session or election would grow without bound.
+    """
+    return group.rsplit('-', 1)[0]
+
+
+# websockets of this process per group, see publish_connections()
+_connections: Dict[str, int] = {}
+_connections_lock = threading.Lock()
+PROCESS_ID = f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+PROCESSES_KEY = 'websocket-processes'
+
+
+def process_connections_key(process_id: str) -> str:
+    return f'websocket-connections-{process_id}'
+
+
+def groups_connected(groups: Iterable[str]):
+    """
+    Count a websocket of this process that joined the groups.
+    """
+    with _connections_lock:
+        for group in groups:
+            _connections[group] = _connections.get(group, 0) + 1
+    publish_connections()
+
+
+def groups_disconnected(groups: Iterable[str]):
+    with _connections_lock:
+        for group in groups:
+            count = _connections.get(group, 0) - 1
+            if count > 0:
+                _connections[group] = count
+            else:
+                _connections.pop(group, None)
+    publish_connections()
+
+
+def publish_connections():
+    """
+    Store the connection counts of this process in the cache, so group_size() can sum them up over all processes.
+
+    The counts expire after WEBSOCKET_CONNECTIONS_TIMEOUT seconds, the consumers publish them again in between (see
+    vote.consumers.ConsumerMetricsMixin). The websockets of a process that was killed stop being counted when they
+    expire. Every process only writes its own counts, so concurrent connections in several processes can't get lost.
+    """
+    with _connections_lock:
+        counts = dict(_connections)
+    cache.set(process_connections_key(PROCESS_ID), counts, timeout=settings.WEBSOCKET_CONNECTIONS_TIMEOUT)
+
+    processes = cache.get(PROCESSES_KEY, set())
+    if PROCESS_ID not in processes:
+        # forget the processes whose counts expired, a process that was lost by a concurrent update adds itself again
+        # the next time it publishes
+        alive = cache.get_many([process_connections_key(process_id) for process_id in processes])
+        processes = {process_id for process_id in processes if process_connections_key(process_id) in alive}
+        cache.set(PROCESSES_KEY, processes | {PROCESS_ID}, timeout=None)
+
+
+def _process_connections() -> Iterable[Dict[str, int]]:
+    processes = cache.get(PROCESSES_KEY, set())
+    return cache.get_many([process_connections_key(process_id) for process_id in processes]).values()
+
+
+def group_size(group: str) -> int:
+    """
+    Number of websockets of all processes that joined the group. Websockets are counted, not users: a voter with the
+    page open in two tabs is counted twice.
+    """
+    return sum(process_counts.get(group, 0) for process_counts in _process_connections())
+
+
+def largest_groups() -> Dict[str, int]:
+    """
+    Size of the largest group of each kind, i.e. the most websockets a single group message of that kind is sent to.
+    """
+    sizes: Dict[str, int] = {}
+    for process_counts in _process_connections():
+        for group, count in process_counts.items():
+            sizes[group] = sizes.get(group, 0) + count
+    largest: Dict[str, int] = {}
+    for group, size in sizes.items():
+        kind = group_kind(group)
+        largest[kind] = max(largest.get(kind, 0), size)
+    return largest
+
+
+class DroppedMessagesHandler(logging.Handler):
+    """
+    Counts the group messages that channels_redis did not deliver because the channels of some websockets were over
+    capacity, which channels_redis only logs. The in-memory channel layer drops these messages silently.
+    """
+    message = '%s of %s channels over capacity in group %s'
+
+    def emit(self, record):
+        if record.msg == self.message:
+            DROPPED_MESSAGES.labels(group_kind(record.args[2])).inc(record.args[0])
+
+
+def count_dropped_messages():
+    logger = logging.getLogger('channels_redis.core')
+    if logger.getEffectiveLevel() > logging.INFO:
+        logger.setLevel(logging.INFO)
+    logger.addHandler(DroppedMessagesHandler())
+
+
+def _database_counts() -> dict:
+    # pylint: disable=import-outside-toplevel
+    from management.models import ElectionManager
+    from vote.models import Election, Session, Voter
+
+    active_voters = Voter.objects.filter(logged_in=True).values('session_id').annotate(count=Count('pk'))
+    return {
+        'elections': Election.objects.count(),
+        'managers': ElectionManager.objects.count(),
+        'sessions': Session.objects.count(),
+        'active_voters': {row['session_id']: row['count'] for row in active_voters},
+    }
+
+
+class WahlfangCollector:
+    """
+    Gauges of the number of elections, managers, sessions, the logged in voters per session and the size of the
+    largest websocket group per kind.
+    """
+
+    def describe(self):
+        # describe without values, otherwise the registry would collect (and query the database) on registration
+        return self._metrics()
+
+    def collect(self):
+        counts = cache.get_or_set('metrics-counts', _database_counts, timeout=settings.METRICS_CACHE_TIMEOUT)
+        return self._metrics(counts, largest_groups())
+
+    @staticmethod
+    def _metrics(counts=None, groups=None):
+        elections = GaugeMetricFamily('wahlfang_election_count', 'Wahlfang Number of Elections')
+        managers = GaugeMetricFamily('wahlfang_election_manager_count', 'Wahlfang Number of Election Managers')
+        sessions = GaugeMetricFamily('wahlfang_session_count', 'Wahlfang Number of Sessions')
+        active_voters = GaugeMetricFamily('wahlfang_active_voters', 'Logged in voters of a session', labels=['session'])
+        fan_out = GaugeMetricFamily('wahlfang_group_fan_out', 'Connected websockets of the largest group of a kind',
+                                    labels=['group'])
+        if counts is not None:
+            elections.add_metric([], counts['elections'])
+            managers.add_metric([], counts['managers'])
+            sessions.add_metric([], counts['sessions'])
+            for session_id, count in counts['active_voters'].items():
+                active_voters.add_metric([str(session_id)], count)
+        if groups is not None:
+            for kind, size in groups.items():
+                fan_out.add_metric([kind], size)
+        return [elections, managers, sessions, active_voters, fan_out]
+
+
+def register_collector():
+    REGISTRY.register(WahlfangCollector())
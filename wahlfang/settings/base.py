@@ -76,12 +76,60 @@ AUTHENTICATION_BACKENDS = {
 
 ASGI_APPLICATION = 'wahlfang.asgi.application'
 
+# The in-memory channel layer and the default cache only work within a single process. Deployments with more than
+# one ASGI process or with the email workers need a shared channel layer (redis) and cache, see docs/deploying.md and
+# `wahlfang check --deploy`.
 CHANNEL_LAYERS = {
     "default": {
         "BACKEND": "channels.layers.InMemoryChannelLayer"
     }
 }
 
+# Identical websocket notifications (e.g. "reload the voter list" after every voter login) that are sent within
+# this many seconds are merged into a single message. Set to 0 to send every notification immediately.
+NOTIFICATION_COALESCE_WINDOW = 0.25
+
+# The following cached objects are invalidated whenever they change. Their timeouts only bound how long a process
+# with its own, unshared cache may use an outdated copy.
+# Seconds the list of elections of a session is cached.
+SESSION_ELECTIONS_CACHE_TIMEOUT = 30
+# Seconds the logged in voters and managers are cached for authenticating requests and websockets.
+USER_CACHE_TIMEOUT = 60
+# Seconds rendered election cards are cached.
+ELECTION_CARD_CACHE_TIMEOUT = 5 * 60
+# Seconds browsers and caching proxies (e.g. a CDN in front of the public spectator pages) may reuse a spectator page
+# without revalidating it. Revalidation is cheap, the page is answered with 304 Not Modified until an election changes.
+SPECTATOR_CACHE_MAX_AGE = 5
+# Seconds the counts of elections, sessions and logged in voters exported as Prometheus metrics are cached, so
+# scrapes don't count the rows of these tables every time.
+METRICS_CACHE_TIMEOUT = 60
+# Seconds the websocket connection counts of a process are kept in the cache. Processes refresh them in between, the
+# connections of a process that was killed stop being counted after this time.
+WEBSOCKET_CONNECTIONS_TIMEOUT = 60
+
+# Invitation and reminder emails are queued in the database and sent by `wahlfang run_workers`.
+# Number of emails sent in parallel by a worker process.
+MAIL_WORKER_CONCURRENCY = 4
+# A failed email is retried after MAIL_JOB_RETRY_DELAY seconds, doubling the delay for every further attempt,
+# and given up after MAIL_JOB_MAX_ATTEMPTS attempts.
+MAIL_JOB_MAX_ATTEMPTS = 5
+MAIL_JOB_RETRY_DELAY = 60
+# Emails that are still marked as being sent after this many seconds are assumed to be lost with their worker
+# and are queued again.
+MAIL_JOB_TIMEOUT = 10 * 60
+# A worker thread sends up to this many emails over one connection to the mail server before reconnecting.
+MAIL_MESSAGES_PER_CONNECTION = 100
+# Token sheets that are still being generated after this many seconds are assumed to be lost with their thread
+# (e.g. because the server was restarted) and are generated again on the next download.
+TOKEN_SHEET_TIMEOUT = 10 * 60
+# How token sheets are rendered: 'latex' runs pdflatex on vote/tex/invitation.tex, 'vector' draws the same layout
+# with the built-in PDF writer, which is much faster and doesn't need a LaTeX installation.
+TOKEN_SHEET_RENDERER = 'latex'
+# Number of worker processes that render the QR codes of large token sheets, None uses all cores.
+QR_RENDER_PROCESSES = None
+# Maximum number of emails per second sent by a worker process, 0 means unlimited.
+MAIL_RATE_LIMIT = 0
+
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
 
@@ -102,6 +150,8 @@ AUTH_PASSWORD_VALIDATORS = [
 
 PASSWORD_HASHERS = [
     'django.contrib.auth.hashers.Argon2PasswordHasher',
+    # only used for the generated voter access codes, see vote.hashers
+    'vote.hashers.AccessCodeHasher',
     'django.contrib.auth.hashers.PBKDF2PasswordHasher',
     'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
     'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
@@ -139,6 +189,9 @@ CSP_IMG_SRC = ("'self'", "data:",)
 
 # File upload, etc...
 MEDIA_URL = '/media/'
+# Uploads that contain personal data (e.g. voter imports) are stored here while they are processed.
+# Unlike MEDIA_ROOT this directory must not be served by the webserver.
+PRIVATE_MEDIA_ROOT = os.path.join(BASE_DIR, 'private_media')
 
 #: Default Logging configuration.
 LOGGING = {